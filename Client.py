@@ -1,5 +1,7 @@
 """
-    Usage: python3 client.py localhost 12000 100
+    Usage: python3 client.py localhost 12000 6000 [--protocol=text|binary]
+               [--compression=none|zlib|lzma] [--compression-level=N]
+               [--peer-ttl=SECONDS]
 
     Adapted from example multi-threaded client code on course homepage
 
@@ -7,12 +9,18 @@
 """
 from socket import *
 from threading import Thread
-import sys, re, os, math, time
+import sys, re, os, math, time, selectors, queue
+from Protocol import sendFrame, FrameDecoder
+from Protocol import binaryProtocolToken, binaryWelcome
+from Protocol import encodeBinaryRequest, decodeBinaryReply, opcodes
+from Protocol import compressionToken, compressionMethods, defaultCompressionLevel
+from Protocol import compressBody
+from Transfer import TransferReceiver, TransferError, sendFile
 
 
-if len(sys.argv) != 4:
+if len(sys.argv) < 4:
     print(
-        "\n===== Error usage, python3 client.py SERVER_IP SERVER_PORT CLIENT_UDP_SERVER_PORT ======\n"
+        "\n===== Error usage, python3 client.py SERVER_IP SERVER_PORT CLIENT_UDP_SERVER_PORT [--option=value ...] ======\n"
     )
     exit(0)
 serverHost = sys.argv[1]
@@ -20,6 +28,51 @@ serverPort = int(sys.argv[2])
 clientUDPServerPort = int(sys.argv[3])
 serverAddress = (serverHost, serverPort)
 
+# Optional settings supplied after the required parameters as --name=value
+clientOptions = {}
+for arg in sys.argv[4:]:
+    if not re.match("^--[a-z-]+=.+$", arg):
+        print(f"Error: unrecognised option {arg}, expected --name=value")
+        exit(0)
+    optionName, optionValue = arg[2:].split("=", 1)
+    clientOptions[optionName] = optionValue
+
+# Protocol requested from the server. 'binary' is a compact encoding for
+# machine to machine use, falling back to 'text' if the server does not accept it
+clientProtocol = clientOptions.get("protocol", "text")
+if clientProtocol not in ["text", "binary"]:
+    print("Error: --protocol must be one of [text, binary]")
+    exit(0)
+binaryMode = False
+
+# Compression for UED uploads, used if the server accepts it, and UVF transfers
+clientCompression = clientOptions.get("compression", "none")
+if clientCompression not in ["none"] + compressionMethods:
+    print(f"Error: --compression must be one of {['none'] + compressionMethods}")
+    exit(0)
+try:
+    compressionLevel = int(
+        clientOptions.get("compression-level", defaultCompressionLevel)
+    )
+    if compressionLevel < 0 or compressionLevel > 9:
+        raise ValueError
+except ValueError:
+    print("Error: --compression-level must be between 0 and 9")
+    exit(0)
+# Compression method the server accepted for UED data, None if not in use
+uploadCompression = None
+# Compression method for UVF chunks, peers decompress whatever they are sent
+uvfCompression = None if clientCompression == "none" else clientCompression
+
+# Seconds a peer's address is reused for UVF before looking it up again
+try:
+    peerTTL = float(clientOptions.get("peer-ttl", "30"))
+    if peerTTL < 0:
+        raise ValueError
+except ValueError:
+    print("Error: --peer-ttl must be a non-negative number of seconds")
+    exit(0)
+
 # Ensure provided UDP port is in valid range
 if clientUDPServerPort < 1024 or clientUDPServerPort > 65535:
     print("Error: Invalid CLIENT_UDP_SERVER_PORT. Must be in range [1024, 65535].")
@@ -33,54 +86,234 @@ clientUDPSocket = socket(AF_INET, SOCK_DGRAM)
 clientTCPSocket.connect(serverAddress)
 clientUDPSocket.bind(("", clientUDPServerPort))
 
-# Allow listener thread to be killed when the interactive one dies
-clientUDPSocket.settimeout(0)
-killUDPThread = False
+# Replies from the server, put here by the I/O thread as they arrive
+# None is put once the connection to the server closes
+serverReplies = queue.Queue()
+
+# The I/O thread waits on its sockets without polling
+clientUDPSocket.setblocking(False)
 
 username = ""
 
-# Constantly running daemon thread to allow UDP contact from another client for UVF command
-# Initialised at startup and killed when 'OUT' command run via the interactive thread
-class ListenerThread(Thread):
+# Commands sent but not yet replied to, by request ID, as (message, pipelined)
+# Each command is tagged with "@ID " so several can be in flight and their
+# replies matched back
+pendingRequests = {}
+nextRequestId = 1
+
+# Known peer addresses for UVF by device name, as ((address, port), fetchTime)
+# fetchTime is None for entries kept current by SUB push events
+peerDirectory = {}
+
+# Commands entered by the user which are sent to the server as typed
+serverCommands = ["EDG", "UED", "SCS", "DTE", "AED", "OUT", "SUB", "STA", "LST"]
+
+# Commands which can be run together in a BAT command
+batchableCommands = ["EDG", "SCS", "DTE", "AED", "LST"]
+
+
+# Given a command message tags it with a new request ID and sends it to the server
+# pipelined is True if it is sent with other commands
+def sendCommand(message, pipelined=False):
+    global nextRequestId
+    requestId = nextRequestId
+    nextRequestId += 1
+    pendingRequests[requestId] = (message, pipelined)
+    if binaryMode:
+        sendFrame(clientTCPSocket, encodeBinaryCommand(message, requestId))
+    elif message[0:3] == "UED":
+        header, fileData = message.split("\n", 1)
+        sendFrame(
+            clientTCPSocket,
+            f"@{requestId} {header}\n".encode() + encodeUploadBody(fileData),
+        )
+    else:
+        sendFrame(clientTCPSocket, f"@{requestId} {message}".encode())
+    return requestId
+
+
+# Given UED file data returns the bytes to send, compressed if the server
+# accepted compression during login
+def encodeUploadBody(fileData):
+    body = fileData.encode()
+    if uploadCompression is not None:
+        body = compressBody(uploadCompression, body, compressionLevel)
+    return body
+
+
+# Given a command message and request ID returns the binary protocol request
+def encodeBinaryCommand(message, requestId):
+    command = message[0:3]
+
+    # BAT commands carry each batched command as a nested request
+    if command == "BAT":
+        fields = [encodeBinaryCommand(sub, 0) for sub in message.split("\n")[1:]]
+        return encodeBinaryRequest(command, requestId, fields)
+
+    # UED file data is sent as the request body
+    body = b""
+    if command == "UED":
+        message, fileData = message.split("\n", 1)
+        body = encodeUploadBody(fileData)
+
+    fields = [arg.encode() for arg in message.split()[1:]]
+    return encodeBinaryRequest(command, requestId, fields, body)
+
+
+# Given a binary reply's command and value prints the result
+def printBinaryReply(command, value):
+    if command == "BAT":
+        for reply in value:
+            replyCommand, requestId, status, replyValue = decodeBinaryReply(reply)
+            printBinaryReply(replyCommand, replyValue)
+    else:
+        print(value)
+
+
+# Given the request ID of a reply stops waiting for the request
+# Returns the command line it answers if it was pipelined with others, so the
+# reply can be shown with it, otherwise None
+def finishRequest(requestId):
+    message, pipelined = pendingRequests.pop(requestId, (None, False))
+    if not pipelined:
+        return None
+    return message.split("\n", 1)[0]
+
+
+# Given a received message removes its request tag if any
+# Returns the command line it answers as from finishRequest, and the message
+def splitReplyTag(receivedMessage):
+    tagMatch = re.match("^@([0-9]+) ", receivedMessage)
+    if tagMatch is None:
+        return None, receivedMessage
+    requestCommand = finishRequest(int(tagMatch.group(1)))
+    return requestCommand, receivedMessage[tagMatch.end() :]
+
+
+# Given a BAT response returns the list of replies it contains
+# Format is the number of replies, then each reply preceded by its length
+def parseBatchReply(receivedMessage):
+    body = re.sub("^BAT resp: \n", "", receivedMessage)
+    nReplies, body = body.split("\n", 1) if "\n" in body else (body, "")
+    replies = []
+    position = 0
+    for i in range(int(nReplies)):
+        lengthEnd = body.index("\n", position)
+        replyLength = int(body[position:lengthEnd])
+        replies.append(body[lengthEnd + 1 : lengthEnd + 1 + replyLength])
+        position = lengthEnd + 2 + replyLength
+    return replies
+
+
+# Daemon thread handling all socket input: replies from the server and UVF
+# transfers from other clients. Waits on the sockets with a selector so it uses
+# no CPU while idle, and is woken through a socket pair to stop
+class IOThread(Thread):
     def __init__(self):
-        Thread.__init__(self)
+        Thread.__init__(self, daemon=True)
+        self.receiver = TransferReceiver(
+            clientUDPSocket, onComplete=self.fileReceived, onError=self.fileFailed
+        )
+        # Every datagram is received into this one buffer
+        self.buffer = bytearray(65536)
+        self.view = memoryview(self.buffer)
+        self.frameDecoder = FrameDecoder()
+        self.wakeupReceiver, self.wakeupSender = socketpair()
+        self.selector = selectors.DefaultSelector()
+        self.running = True
 
     def run(self):
-        while not killUDPThread:
-            # Non-blocking recvfrom() to allow thread to be killed
+        self.selector.register(clientUDPSocket, selectors.EVENT_READ, self.readUDP)
+        self.selector.register(clientTCPSocket, selectors.EVENT_READ, self.readTCP)
+        self.selector.register(self.wakeupReceiver, selectors.EVENT_READ, None)
+
+        while self.running:
+            # Sleep until a socket is readable or a delayed ACK or timeout is due
+            nextTick = self.receiver.tick()
+            timeout = None
+            if nextTick is not None:
+                timeout = max(0, nextTick - time.monotonic())
+
+            for key, events in self.selector.select(timeout):
+                if key.data is not None:
+                    key.data()
+
+        self.selector.close()
+        self.wakeupReceiver.close()
+        self.wakeupSender.close()
+
+    # Wakes the thread and makes it stop
+    def stop(self):
+        self.running = False
+        self.wakeupSender.send(b"\0")
+
+    # Passes every queued datagram to the UVF receiver
+    def readUDP(self):
+        while True:
             try:
-                # Receive header message from other client
-                data, recvAddress = clientUDPSocket.recvfrom(4096)
-            except:
+                n, recvAddress = clientUDPSocket.recvfrom_into(self.buffer)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # Errors such as ICMP port unreachable from an old transfer
                 continue
 
-            # 'latin-1' encoding used as 'utf-8' fails for some reason
-            message = data.decode("latin-1")
-
-            if message[0:3] != "UVF":
+            # A bad datagram must not stop the thread serving the server connection
+            try:
+                handled = self.receiver.handlePacket(self.view[:n], recvAddress)
+            except Exception as error:
+                print(f"\nDropped UVF packet from {recvAddress}: {error}")
+                continue
+            if not handled:
                 print(f"\nCorrupted UVF file from {recvAddress} received.")
-            else:
-                # Extract information from header
-                message = message.split()
-                fileName = message[1]
-                nPacketsToRecv = int(message[2])
-                senderDevice = message[3]
-
-                outFile = open(fileName, "ab")
-
-                # Temporarily remove socket non-blocking for file transfer
-                clientUDPSocket.settimeout(5)
 
-                # Receive and write each packet to file
-                for i in range(0, nPacketsToRecv):
-                    data, recvAddress = clientUDPSocket.recvfrom(4096)
-                    outFile.write(data)
-
-                outFile.close()
-                print(f"\nFile {fileName} received from {senderDevice}")
-
-            # Reinstate socket non-blocking
-            clientUDPSocket.settimeout(0)
+    # Queues every whole reply received from the server
+    # None is queued once the connection closes or sends something unreadable, so
+    # the main thread never waits for a reply which cannot come
+    def readTCP(self):
+        try:
+            data = clientTCPSocket.recv(65536)
+        except OSError:
+            data = b""
+        if data == b"":
+            self.selector.unregister(clientTCPSocket)
+            serverReplies.put(None)
+            return
+        try:
+            for message in self.frameDecoder.feed(data):
+                # Pushed device events are handled here, everything else is a reply
+                if binaryMode and message[0] == opcodes["PSH"]:
+                    command, requestId, status, event = decodeBinaryReply(message)
+                    self.deviceEvent(event)
+                elif not binaryMode and message[0:1] == b"!":
+                    self.deviceEvent(message[1:].decode())
+                else:
+                    serverReplies.put(message)
+        except Exception as error:
+            print(f"\nBad message from the server: {error}")
+            self.selector.unregister(clientTCPSocket)
+            serverReplies.put(None)
+
+    # Given a pushed device event updates the peer directory
+    # Events are 'join deviceName IPAddress UDPPort' and 'leave deviceName'
+    def deviceEvent(self, event):
+        args = event.split()
+        if args[0] == "join" and len(args) == 4:
+            peerDirectory[args[1]] = ((args[2], int(args[3])), None)
+            print(f"\nEdge device {args[1]} is active")
+        elif args[0] == "leave" and len(args) == 2:
+            peerDirectory.pop(args[1], None)
+            print(f"\nEdge device {args[1]} left the network")
+
+    # Given a finished transfer reports it
+    def fileReceived(self, transfer):
+        print(f"\nFile {transfer.fileName} received from {transfer.senderName}")
+
+    # Given an abandoned transfer and reason reports it
+    def fileFailed(self, transfer, reason):
+        print(
+            f"\nFile {transfer.fileName} from {transfer.senderName} not received: {reason}"
+        )
 
 
 # Main thread to allow interaction for a user
@@ -89,118 +322,175 @@ class InteractiveThread(Thread):
         Thread.__init__(self)
 
     def run(self):
+        global username, binaryMode, uploadCompression
+
         while True:
             # Receive response from the server
-            data = clientTCPSocket.recv(1024)
-            receivedMessage = data.decode()
-
-            # RC bit header used to track if a standard command is required after response received
-            # Standard command is one of [EDG, UED, SCS, DTE, AED, OUT]
-            # RC1 = command required, RC0 = other (eg. username or password request)
-            commandRequested = False
-
-            if re.match("^RC1;.*", receivedMessage):
-                commandRequested = True
-
-            # Remove RC header
-            receivedMessage = receivedMessage[4:]
-
-            # Error checking for empty response
-            if receivedMessage.strip() == "" or receivedMessage.strip() == "\r":
-                print("[recv] Message from server is empty!")
-
-            ### Auth related responses:
-
-            # Get and send username
-            elif (
-                receivedMessage == "username authentication request\r"
-                or receivedMessage == "retry username authentication request\r"
-            ):
-                if receivedMessage == "retry username authentication request\r":
-                    print("Invalid Username. Please try again.")
-                message = input("Username: ").strip()
-                username = message
-                # UDP Server Port sent with username
-                message += f" {clientUDPServerPort}"
-                clientTCPSocket.send(message.encode())
-
-            # Get and send password
-            elif (
-                receivedMessage == "password authentication request\r"
-                or receivedMessage == "retry password authentication request\r"
-            ):
-                if receivedMessage == "retry password authentication request\r":
-                    print("Invalid Password. Please try again.")
-                message = input("Password: ").strip()
-                clientTCPSocket.send(message.encode())
-
-            # Max failed auth attempts. Account blocked.
-            elif receivedMessage == "max failed attempts\r":
-                print(
-                    "Invalid Password. Your account has been blocked for 10s. Please try again later"
-                )
+            data = serverReplies.get()
+            if data is None:
+                print("Connection to the server was lost.")
                 break
 
-            # Attempt to login to blocked account
-            elif receivedMessage == "blocked account\r":
-                print(
-                    "Your account is blocked due to multiple authentication failures. Please try again later"
-                )
-                break
-            elif receivedMessage == "username already logged in\r":
-                print("This username is already logged in. Try another.")
-                message = input("Username: ").strip()
-                username = message
-                clientTCPSocket.send(message.encode())
-
-            # Disconnect
-            elif receivedMessage == "successfully disconnected\r":
-                # Kill UDP listening thread
-                global killUDPThread
-                killUDPThread = True
-                print("Successfully logged out. Goodbye!")
-                break
+            # Binary replies carry their command and status, no header matching needed
+            if binaryMode:
+                command, requestId, status, value = decodeBinaryReply(data)
+                requestCommand = finishRequest(requestId)
+                commandRequested = status == 1 and len(pendingRequests) == 0
+
+                if command == "OUT":
+                    print("Successfully logged out. Goodbye!")
+                    break
+                if requestCommand is not None:
+                    print(f"[{requestCommand}]")
+                printBinaryReply(command, value)
 
-            ### Command-related responses:
-
-            # Get command
-            elif (
-                receivedMessage == "welcome\r"
-                or receivedMessage == "command request\r"
-                or receivedMessage == "Cannot understand this message\r"
-            ):
-                if receivedMessage == "welcome\r":
-                    print("Welcome!")
-
-            # AED
-            elif re.match("^AED resp: \n.*", receivedMessage):
-                # Remove header
-                resp = re.sub("^AED resp: \n", "", receivedMessage)
-                print(resp)
-
-            # EDG
-            elif re.match("^EDG resp: \n.*", receivedMessage):
-                resp = re.sub("^EDG resp: \n", "", receivedMessage)
-                print(resp)
-
-            # DTE
-            elif re.match("^DTE resp: \n.*", receivedMessage):
-                resp = re.sub("^DTE resp: \n", "", receivedMessage)
-                print(resp)
-
-            # SCS
-            elif re.match("^SCS resp: \n.*", receivedMessage):
-                resp = re.sub("^SCS resp: \n", "", receivedMessage)
-                print(resp)
-
-            # UED
-            elif re.match("^UED resp: \n.*", receivedMessage):
-                resp = re.sub("^UED resp: \n", "", receivedMessage)
-                print(resp)
-
-            ### Misc:
             else:
-                print(f"Error: Unknown server response received - {receivedMessage}")
+                requestCommand, receivedMessage = splitReplyTag(data.decode())
+                # Replies to pipelined commands are shown with the command they answer
+                if requestCommand is not None:
+                    print(f"[{requestCommand}]")
+
+                # RC bit header used to track if a standard command is required after response received
+                # Standard command is one of [EDG, UED, SCS, DTE, AED, OUT]
+                # RC1 = command required, RC0 = other (eg. username or password request)
+                # With pipelined commands the next command is only requested after the last reply
+                commandRequested = False
+
+                if re.match("^RC1;.*", receivedMessage) and len(pendingRequests) == 0:
+                    commandRequested = True
+
+                # Remove RC header
+                receivedMessage = receivedMessage[4:]
+
+                # Error checking for empty response
+                if receivedMessage.strip() == "":
+                    print("[recv] Message from server is empty!")
+
+                ### Auth related responses:
+
+                # Get and send username
+                elif (
+                    receivedMessage == "username authentication request"
+                    or receivedMessage == "retry username authentication request"
+                ):
+                    if receivedMessage == "retry username authentication request":
+                        print("Invalid Username. Please try again.")
+                    message = input("Username: ").strip()
+                    username = message
+                    # UDP Server Port sent with username
+                    message += f" {clientUDPServerPort}"
+                    if clientProtocol == "binary":
+                        message += f" {binaryProtocolToken}"
+                    if clientCompression != "none":
+                        message += f" {compressionToken}={clientCompression}"
+                    sendFrame(clientTCPSocket, message.encode())
+
+                # Get and send password
+                elif (
+                    receivedMessage == "password authentication request"
+                    or receivedMessage == "retry password authentication request"
+                ):
+                    if receivedMessage == "retry password authentication request":
+                        print("Invalid Password. Please try again.")
+                    message = input("Password: ").strip()
+                    sendFrame(clientTCPSocket, message.encode())
+
+                # Max failed auth attempts. Account blocked.
+                elif receivedMessage == "max failed attempts":
+                    print(
+                        "Invalid Password. Your account has been blocked for 10s. Please try again later"
+                    )
+                    break
+
+                # Attempt to login to blocked account
+                elif receivedMessage == "blocked account":
+                    print(
+                        "Your account is blocked due to multiple authentication failures. Please try again later"
+                    )
+                    break
+                elif receivedMessage == "username already logged in":
+                    print("This username is already logged in. Try another.")
+                    message = input("Username: ").strip()
+                    username = message
+                    sendFrame(clientTCPSocket, message.encode())
+
+                # Disconnect
+                elif receivedMessage == "successfully disconnected":
+                    print("Successfully logged out. Goodbye!")
+                    break
+
+                ### Command-related responses:
+
+                # Get command
+                elif (
+                    receivedMessage.split(" ")[0] == "welcome"
+                    or receivedMessage == "command request"
+                    or receivedMessage == "Cannot understand this message"
+                ):
+                    if receivedMessage.split(" ")[0] == "welcome":
+                        print("Welcome!")
+                    # Server replies in the binary protocol from now on
+                    if receivedMessage.startswith(binaryWelcome):
+                        binaryMode = True
+                    # Server repeats the compression method if it accepts it
+                    if (
+                        f"{compressionToken}={clientCompression}"
+                        in receivedMessage.split()
+                    ):
+                        uploadCompression = clientCompression
+
+                # AED
+                elif re.match("^AED resp: \n.*", receivedMessage):
+                    # Remove header
+                    resp = re.sub("^AED resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # EDG
+                elif re.match("^EDG resp: \n.*", receivedMessage):
+                    resp = re.sub("^EDG resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # DTE
+                elif re.match("^DTE resp: \n.*", receivedMessage):
+                    resp = re.sub("^DTE resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # SCS
+                elif re.match("^SCS resp: \n.*", receivedMessage):
+                    resp = re.sub("^SCS resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # UED
+                elif re.match("^UED resp: \n.*", receivedMessage):
+                    resp = re.sub("^UED resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # STA
+                elif re.match("^STA resp: \n.*", receivedMessage):
+                    resp = re.sub("^STA resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # LST
+                elif re.match("^LST resp: \n.*", receivedMessage):
+                    resp = re.sub("^LST resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # SUB
+                elif re.match("^SUB resp: \n.*", receivedMessage):
+                    resp = re.sub("^SUB resp: \n", "", receivedMessage)
+                    print(resp)
+
+                # BAT
+                elif re.match("^BAT resp: \n.*", receivedMessage):
+                    for reply in parseBatchReply(receivedMessage):
+                        # Remove RC and response headers of each reply
+                        print(re.sub("^RC[01];([A-Z]{3} resp: \n)?", "", reply))
+
+                ### Misc:
+                else:
+                    print(
+                        f"Error: Unknown server response received - {receivedMessage}"
+                    )
 
             # If RC header was set to 1
             if commandRequested:
@@ -208,44 +498,11 @@ class InteractiveThread(Thread):
                 validInput = False
                 while not validInput:
                     message = input(
-                        "Enter one of the following commands (EDG, UED, SCS, DTE, AED, OUT, UVF): "
+                        "Enter one of the following commands (EDG, UED, SCS, DTE, AED, OUT, UVF, BAT, SUB, STA, LST): "
                     ).strip()
 
-                    # Check valid command
-                    if message[0:3] not in [
-                        "EDG",
-                        "UED",
-                        "SCS",
-                        "DTE",
-                        "AED",
-                        "OUT",
-                        "UVF",
-                    ]:
-                        print("Invalid command.")
-
-                    # UED command
-                    elif message[0:3] == "UED":
-                        # Check args provided
-                        args = message.split()
-                        if len(args) != 2:
-                            print("A fileID is needed to upload data.")
-                        elif not os.path.exists(f"{username}-{args[1]}.txt"):
-                            print("The file to be uploaded does not exist.")
-                        else:
-                            validInput = True
-
-                            requestedFileName = f"{username}-{args[1]}.txt"
-                            requestedFile = open(requestedFileName, "r")
-
-                            # Add all data from file into message on new line after header
-                            message += "\n"
-                            for line in requestedFile.readlines():
-                                message += line
-
-                            clientTCPSocket.send(message.encode())
-
                     # UVF command
-                    elif message[0:3] == "UVF":
+                    if message[0:3] == "UVF":
                         # Check args provided
                         args = message.split()
                         if len(args) != 3:
@@ -262,82 +519,156 @@ class InteractiveThread(Thread):
                             if deviceDetails == None:
                                 print(f"{deviceName} is offline.")
                             else:
-                                packetSize = 4096
-
-                                # Calculate number of packets
-                                fileSize = os.path.getsize(fileName)
-                                nPackets = math.ceil(fileSize / packetSize)
-
-                                # Create and send header
-                                message = f"UVF {fileName} {nPackets} {username}"
-                                clientUDPSocket.sendto(
-                                    message.encode("latin-1"), deviceDetails
-                                )
-
-                                # Break file into packets reading 4096 bytes at a time and send
-                                # Adapted from: https://stackoverflow.com/questions/6787233/python-how-to-read-bytes-from-file-and-save-it
-                                byteFile = open(fileName, "rb")
-                                sentPackets = 0
-                                while True:
-                                    packet = byteFile.read(packetSize)
-                                    sentPackets += 1
-
-                                    # Exit loop on empty packet
-                                    if packet == b"":
-                                        break
-
-                                    time.sleep(0.25)
+                                # Reliable transfer, reporting progress every 10%
+                                progressShown = [0]
+
+                                def showProgress(nAcked, nChunks):
+                                    percent = math.floor(100 * nAcked / nChunks)
+                                    if (
+                                        percent >= progressShown[0] + 10
+                                        or nAcked == nChunks
+                                    ):
+                                        progressShown[0] = percent
+                                        print(
+                                            f"Sent {nAcked}/{nChunks} packets ({percent}%)"
+                                        )
+
+                                try:
+                                    sendFile(
+                                        fileName,
+                                        deviceDetails,
+                                        username,
+                                        showProgress,
+                                        compression=uvfCompression,
+                                        compressionLevel=compressionLevel,
+                                    )
                                     print(
-                                        f"Sending packet {sentPackets}/{nPackets} ({math.floor(100 * sentPackets/nPackets)}%)"
+                                        f"{fileName} successfully sent to {deviceName}."
                                     )
-                                    clientUDPSocket.sendto(packet, deviceDetails)
+                                except (TransferError, OSError) as error:
+                                    # Address may be stale, look it up again next time
+                                    peerDirectory.pop(deviceName, None)
+                                    print(
+                                        f"{fileName} could not be sent to {deviceName}: {error}"
+                                    )
+
+                    # BAT command
+                    # Usage: BAT command; command; ...
+                    elif message[0:3] == "BAT":
+                        commands = [
+                            command.strip()
+                            for command in message[3:].split(";")
+                            if command.strip() != ""
+                        ]
+                        if len(commands) == 0:
+                            print("BAT requires commands separated by ';'.")
+                        elif any(
+                            command[0:3] not in batchableCommands
+                            for command in commands
+                        ):
+                            print(
+                                f"Only {', '.join(batchableCommands)} commands can be batched."
+                            )
+                        else:
+                            validInput = True
+                            sendCommand("BAT\n" + "\n".join(commands))
+
+                    # Pipelined commands
+                    # Usage: command; command; ...
+                    elif ";" in message:
+                        commands = [
+                            self.prepareCommand(command.strip(), True)
+                            for command in message.split(";")
+                        ]
+                        if None not in commands:
+                            validInput = True
+                            for command in commands:
+                                sendCommand(command, True)
 
-                                byteFile.close()
-                                print(f"{fileName} successfully sent to {deviceName}.")
                     else:
-                        validInput = True
-                        clientTCPSocket.send(message.encode())
+                        command = self.prepareCommand(message, False)
+                        if command is not None:
+                            validInput = True
+                            sendCommand(command)
+
+    # Given a command entered by the user checks it is valid and builds the message
+    # to send. Returns None after printing the problem if invalid
+    def prepareCommand(self, message, pipelined):
+        # Check valid command
+        if message[0:3] not in serverCommands:
+            print("Invalid command.")
+            return None
 
-    # Given a deviceName, checks it is active and gets address and port via AED command
-    # Return None if device not found, otherwise a tuple with address and port
-    def getDeviceDetails(self, deviceName):
-        # Send and receive AED command
-        clientTCPSocket.send("AED".encode())
-        data = clientTCPSocket.recv(1024)
-        receivedAED = data.decode()
+        if pipelined and message[0:3] == "OUT":
+            print("OUT cannot be sent with other commands.")
+            return None
+
+        # UED command
+        if message[0:3] == "UED":
+            # Check args provided
+            args = message.split()
+            if len(args) != 2:
+                print("A fileID is needed to upload data.")
+                return None
+            elif not os.path.exists(f"{username}-{args[1]}.txt"):
+                print("The file to be uploaded does not exist.")
+                return None
 
-        # Extract information from AED output
-        # Example AED ouput:
-        # 'test2, active since 09 November 2022 14:18:07, IP address: 1, UDP port number: 0'
-        devicesInfo = receivedAED.split("\n")
+            requestedFileName = f"{username}-{args[1]}.txt"
+            requestedFile = open(requestedFileName, "r")
 
-        # Remove header line
-        devicesInfo = devicesInfo[1:]
+            # Add all data from file into message on new line after header
+            message += "\n" + requestedFile.read()
+            requestedFile.close()
 
-        # Scrape required information
-        if devicesInfo[0] == "no other active edge devices":
+        return message
+
+    # Given a deviceName gets its address and port, from the peer directory if
+    # kept current by SUB or fetched within peerTTL seconds, otherwise via LKP
+    # Return None if device not found, otherwise a tuple with address and port
+    def getDeviceDetails(self, deviceName):
+        cached = peerDirectory.get(deviceName)
+        if cached is not None and (
+            cached[1] is None or time.monotonic() - cached[1] < peerTTL
+        ):
+            return cached[0]
+
+        # Send and receive LKP command
+        sendCommand(f"LKP {deviceName}")
+        data = serverReplies.get()
+        if data is None:
+            # Leave the closed connection for the main loop to report
+            serverReplies.put(None)
             return None
+
+        if binaryMode:
+            command, requestId, status, receivedLKP = decodeBinaryReply(data)
+            pendingRequests.pop(requestId, None)
         else:
-            for device in devicesInfo:
-                deviceInfo = device.split()
-                name = deviceInfo[0][:-1]
-                if name != deviceName:
-                    continue
-                address = deviceInfo[9][:-1]
-                port = int(deviceInfo[13])
-                return (address, port)
-        return None
+            requestCommand, receivedLKP = splitReplyTag(data.decode())
+            # Remove header line
+            receivedLKP = receivedLKP.split("\n", 1)[-1]
+
+        # Reply is 'address port', or a message if the device is not active
+        lookupMatch = re.match("^(\\S+) ([0-9]+)$", receivedLKP)
+        if lookupMatch is None:
+            peerDirectory.pop(deviceName, None)
+            return None
+        deviceDetails = (lookupMatch.group(1), int(lookupMatch.group(2)))
+        peerDirectory[deviceName] = (deviceDetails, time.monotonic())
+        return deviceDetails
 
 
-# Create the main and listener threads
-listenerThread = ListenerThread()
+# Create the interactive and I/O threads
+ioThread = IOThread()
 intThread = InteractiveThread()
-listenerThread.start()
+ioThread.start()
 intThread.start()
 
-# Close the sockets after threads are killed
-while intThread.is_alive() and listenerThread.is_alive():
-    continue
+# Stop the I/O thread and close the sockets once the user is done
+intThread.join()
+ioThread.stop()
+ioThread.join()
 
 clientTCPSocket.close()
 clientUDPSocket.close()
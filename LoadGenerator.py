@@ -0,0 +1,375 @@
+"""
+    Usage: python3 LoadGenerator.py SERVER_PORT [--option=value ...]
+
+    Headless load generator for the server. Opens concurrent sessions which log
+    in with the real handshake and run a weighted mix of commands, then reports
+    throughput, latency percentiles, errors and the server's memory use.
+
+    Options:
+        --sessions=N        concurrent sessions (default 10)
+        --duration=SECONDS  how long to generate load for (default 10)
+        --mix=CMD:W,...     command weights from AED, EDG, SCS, UED, DTE, OUT
+                            (default AED:3,EDG:1,SCS:4,UED:1,DTE:1)
+        --data-amount=N     lines per file for EDG and UED (default 1000)
+        --spawn=MODE        start a server in MODE (threaded or asyncio) in a
+                            temporary directory with generated accounts
+        --server-pid=PID    pid of an already running server, for memory use
+        --host=HOST         server address (default 127.0.0.1)
+
+Without --spawn the accounts in credentials.txt in the current directory are
+used, one per session, so there must be at least as many as sessions.
+"""
+from socket import create_connection
+import sys, os, re, time, random, asyncio, subprocess, tempfile, shutil
+from Protocol import encodeFrame, recvFrameAsync, ProtocolError
+
+
+if len(sys.argv) < 2:
+    print("\nError usage: python3 LoadGenerator.py SERVER_PORT [--option=value ...]")
+    exit(0)
+serverPort = int(sys.argv[1])
+
+# Optional settings supplied after the required parameters as --name=value
+loadOptions = {}
+for arg in sys.argv[2:]:
+    if not re.match("^--[a-z-]+=.+$", arg):
+        print(f"\nError usage: unrecognised option {arg}, expected --name=value")
+        exit(0)
+    optionName, optionValue = arg[2:].split("=", 1)
+    loadOptions[optionName] = optionValue
+
+try:
+    nSessions = int(loadOptions.get("sessions", 10))
+    duration = float(loadOptions.get("duration", 10))
+    dataAmount = int(loadOptions.get("data-amount", 1000))
+    serverPid = int(loadOptions.get("server-pid", 0))
+
+    # Command -> relative weight in the mix
+    commandMix = {}
+    for entry in loadOptions.get("mix", "AED:3,EDG:1,SCS:4,UED:1,DTE:1").split(","):
+        command, weight = entry.split(":")
+        commandMix[command] = float(weight)
+except ValueError:
+    print(
+        "\nError usage: --sessions, --duration, --data-amount and --server-pid are numbers, --mix is CMD:WEIGHT,..."
+    )
+    exit(0)
+serverHost = loadOptions.get("host", "127.0.0.1")
+spawnMode = loadOptions.get("spawn")
+if spawnMode not in [None, "threaded", "asyncio"]:
+    print("\nError usage: --spawn must be one of [threaded, asyncio]")
+    exit(0)
+
+for command, weight in commandMix.items():
+    if command not in ["AED", "EDG", "SCS", "UED", "DTE", "OUT"]:
+        print(f"\nError usage: {command} cannot be in the mix")
+        exit(0)
+    if not 0 <= weight < float("inf"):
+        print(f"\nError usage: {command} needs a weight of 0 or more in the mix")
+        exit(0)
+if sum(commandMix.values()) == 0:
+    print("\nError usage: --mix needs a command with a weight above 0")
+    exit(0)
+mixCommands = list(commandMix)
+mixWeights = [commandMix[command] for command in mixCommands]
+
+# UED upload body, the same for every upload
+uploadData = "\n".join(str(i) for i in range(1, dataAmount + 1))
+
+"""
+    Results
+"""
+
+# Command -> list of latencies in seconds, and command -> number of errors
+latencies = {}
+errors = {}
+
+
+# Given a command and latency records a completed command
+def recordLatency(command, seconds):
+    if command not in latencies:
+        latencies[command] = []
+    latencies[command].append(seconds)
+
+
+# Given a command and what went wrong records an error
+def recordError(command, reason):
+    errors[command] = errors.get(command, 0) + 1
+    if errors[command] == 1:
+        print(f"First {command} error: {reason}")
+
+
+# Given sorted latencies and a fraction returns that percentile in milliseconds
+def percentile(sortedLatencies, fraction):
+    index = min(int(fraction * len(sortedLatencies)), len(sortedLatencies) - 1)
+    return sortedLatencies[index] * 1000
+
+
+# Given a pid returns its resident memory in KiB from /proc, or None if unknown
+def readRSS(pid):
+    try:
+        statusFile = open(f"/proc/{pid}/status", "r")
+    except OSError:
+        return None
+    rss = None
+    for line in statusFile:
+        if line.startswith("VmRSS:"):
+            rss = int(line.split()[1])
+    statusFile.close()
+    return rss
+
+
+"""
+    Sessions
+"""
+
+
+# One simulated edge device. Logs in, then runs commands from the mix until
+# the deadline, logging in again after each OUT
+class LoadSession:
+    def __init__(self, username, password, udpPort):
+        self.username = username
+        self.password = password
+        self.udpPort = udpPort
+        self.reader = None
+        self.writer = None
+        # File IDs this session has created on the server
+        self.fileIDs = []
+        self.nextFileID = 1
+
+    # Given a message sends it and returns the reply text
+    async def request(self, message):
+        self.writer.write(encodeFrame(message.encode()))
+        reply = await recvFrameAsync(self.reader)
+        if reply is None:
+            raise ConnectionError("server closed the connection")
+        return reply.decode()
+
+    # Connects and logs in, recording the time taken as LOGIN
+    async def login(self):
+        startTime = time.perf_counter()
+        self.reader, self.writer = await asyncio.open_connection(serverHost, serverPort)
+        reply = await recvFrameAsync(self.reader)
+        if reply is None or not reply.decode().endswith(
+            "username authentication request"
+        ):
+            raise ConnectionError(f"unexpected greeting {reply}")
+        reply = await self.request(f"{self.username} {self.udpPort}")
+        if reply != "RC0;password authentication request":
+            raise ConnectionError(f"username rejected: {reply}")
+        reply = await self.request(self.password)
+        if reply != "RC1;welcome":
+            raise ConnectionError(f"password rejected: {reply}")
+        recordLatency("LOGIN", time.perf_counter() - startTime)
+
+    # Closes the connection if open
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    # Given a command from the mix returns the message to send
+    def buildMessage(self, command):
+        if command == "AED" or command == "OUT":
+            return command
+        if command == "EDG":
+            fileID = self.nextFileID
+            self.nextFileID += 1
+            self.fileIDs.append(fileID)
+            return f"EDG {fileID} {dataAmount}"
+        if command == "UED":
+            fileID = self.nextFileID
+            self.nextFileID += 1
+            self.fileIDs.append(fileID)
+            return f"UED {fileID}\n{uploadData}"
+
+        # SCS and DTE work on a file this session created, if there is one
+        if len(self.fileIDs) == 0:
+            fileID = 0
+        elif command == "DTE":
+            fileID = self.fileIDs.pop(random.randrange(len(self.fileIDs)))
+        else:
+            fileID = random.choice(self.fileIDs)
+        if command == "SCS":
+            return f"SCS {fileID} {random.choice(['SUM', 'AVERAGE', 'MAX', 'MIN'])}"
+        return f"DTE {fileID}"
+
+    # Given a command and its reply returns the problem with the reply, or None
+    def checkReply(self, command, message, reply):
+        if command == "OUT":
+            expected = reply == "RC0;successfully disconnected"
+        else:
+            expected = reply.startswith(f"RC1;{command} resp: \n")
+        if not expected:
+            return f"unexpected reply {reply[:60]!r}"
+
+        # SCS and DTE sent before the session has any file expect to find nothing
+        if "does not exist" in reply and message.split()[1] != "0":
+            return "file missing"
+        return None
+
+    async def run(self, deadline):
+        try:
+            await self.login()
+        except (OSError, ConnectionError, ProtocolError) as error:
+            recordError("LOGIN", error)
+            return
+
+        while time.monotonic() < deadline:
+            command = random.choices(mixCommands, mixWeights)[0]
+            message = self.buildMessage(command)
+            startTime = time.perf_counter()
+            try:
+                reply = await self.request(message)
+            except (OSError, ConnectionError, ProtocolError) as error:
+                recordError(command, error)
+                self.close()
+                return
+            recordLatency(command, time.perf_counter() - startTime)
+
+            problem = self.checkReply(command, message, reply)
+            if problem is not None:
+                recordError(command, problem)
+
+            if command == "OUT":
+                self.close()
+                try:
+                    await self.login()
+                except (OSError, ConnectionError, ProtocolError) as error:
+                    recordError("LOGIN", error)
+                    return
+
+        try:
+            await self.request("OUT")
+        except (OSError, ConnectionError, ProtocolError):
+            pass
+        self.close()
+
+
+# Given the pid to watch records the highest resident memory seen until cancelled
+async def watchMemory(pid, samples):
+    while True:
+        rss = readRSS(pid)
+        if rss is not None:
+            samples.append(rss)
+        await asyncio.sleep(0.5)
+
+
+async def runLoad(accounts, pid):
+    deadline = time.monotonic() + duration
+    sessions = [
+        LoadSession(username, password, 10000 + i)
+        for i, (username, password) in enumerate(accounts)
+    ]
+    rssSamples = []
+    watcher = None
+    if pid:
+        watcher = asyncio.create_task(watchMemory(pid, rssSamples))
+
+    startTime = time.monotonic()
+    await asyncio.gather(*[session.run(deadline) for session in sessions])
+    elapsed = time.monotonic() - startTime
+
+    if watcher is not None:
+        watcher.cancel()
+    return elapsed, rssSamples
+
+
+"""
+    Setup and report
+"""
+
+
+# Given a directory and number of accounts writes generated credentials there
+# Returns the list of (username, password)
+def generateAccounts(directory, nAccounts):
+    accounts = [(f"load-device-{i}", f"pass{i}") for i in range(nAccounts)]
+    credsFile = open(os.path.join(directory, "credentials.txt"), "w")
+    for username, password in accounts:
+        credsFile.write(f"{username} {password}\n")
+    credsFile.close()
+    return accounts
+
+
+# Reads accounts from credentials.txt in the current directory
+def readAccounts():
+    accounts = []
+    credsFile = open("credentials.txt", "r")
+    for line in credsFile:
+        lineCreds = line.split()
+        if len(lineCreds) >= 2:
+            accounts.append((lineCreds[0], lineCreds[1]))
+    credsFile.close()
+    return accounts
+
+
+# Given a directory and mode starts a server there. Returns the process
+def spawnServer(directory, mode):
+    serverScript = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Server.py")
+    serverProcess = subprocess.Popen(
+        [sys.executable, serverScript, str(serverPort), "5", f"--mode={mode}"],
+        cwd=directory,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    # Wait until it accepts connections
+    for attempt in range(50):
+        try:
+            create_connection((serverHost, serverPort)).close()
+            return serverProcess
+        except OSError:
+            time.sleep(0.1)
+    serverProcess.kill()
+    print("Error: spawned server did not start")
+    exit(0)
+
+
+def printReport(elapsed, rssSamples):
+    totalCommands = sum(len(values) for values in latencies.values())
+    totalErrors = sum(errors.values())
+    print(f"\n===== Load report: {nSessions} sessions, {elapsed:.1f}s =====")
+    print(f"commands: {totalCommands}, {totalCommands / elapsed:.1f}/s")
+    print(f"errors: {totalErrors}")
+    print(
+        f"{'command':<8}{'count':>8}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'max ms':>10}"
+    )
+    for command in sorted(set(latencies) | set(errors)):
+        values = sorted(latencies.get(command, []))
+        if len(values) == 0:
+            print(f"{command:<8}{0:>8}{errors.get(command, 0):>8}")
+            continue
+        print(
+            f"{command:<8}{len(values):>8}{errors.get(command, 0):>8}"
+            f"{percentile(values, 0.5):>10.2f}{percentile(values, 0.95):>10.2f}"
+            f"{percentile(values, 0.99):>10.2f}{values[-1] * 1000:>10.2f}"
+        )
+    if len(rssSamples) > 0:
+        print(f"server RSS: {rssSamples[-1]} KiB at end, {max(rssSamples)} KiB peak")
+    else:
+        print("server RSS: unknown, give --server-pid or --spawn")
+
+
+serverProcess = None
+workDirectory = None
+if spawnMode is not None:
+    workDirectory = tempfile.mkdtemp(prefix="iot-load-")
+    accounts = generateAccounts(workDirectory, nSessions)
+    serverProcess = spawnServer(workDirectory, spawnMode)
+    serverPid = serverProcess.pid
+else:
+    accounts = readAccounts()
+    if len(accounts) < nSessions:
+        print(
+            f"Error: credentials.txt has {len(accounts)} accounts for {nSessions} sessions"
+        )
+        exit(0)
+    accounts = accounts[:nSessions]
+
+try:
+    elapsed, rssSamples = asyncio.run(runLoad(accounts, serverPid))
+    printReport(elapsed, rssSamples)
+finally:
+    if serverProcess is not None:
+        serverProcess.terminate()
+        serverProcess.wait()
+        shutil.rmtree(workDirectory, ignore_errors=True)
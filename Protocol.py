@@ -0,0 +1,324 @@
+"""
+    Message framing shared by the client and server TCP connection.
+
+    Every message is sent as a 4 byte big-endian length header followed by
+    the message bytes, so a message can be any size and back-to-back messages
+    never merge together.
+"""
+import struct, asyncio, zlib, lzma
+
+headerStruct = struct.Struct("!I")
+headerSize = headerStruct.size
+
+# Largest message accepted from the other side, guards against garbage headers
+maxMessageSize = 1 << 30
+
+# Messages smaller than this are joined with their header into a single send
+smallMessageSize = 64 * 1024
+
+
+class ProtocolError(Exception):
+    pass
+
+
+# Given message bytes returns them with the length header prepended
+def encodeFrame(data):
+    return headerStruct.pack(len(data)) + data
+
+
+# Given a connected socket and message bytes sends the framed message
+def sendFrame(sock, data):
+    if len(data) < smallMessageSize:
+        sock.sendall(encodeFrame(data))
+    else:
+        # Avoid copying large payloads just to prepend the header
+        sock.sendall(headerStruct.pack(len(data)))
+        sock.sendall(data)
+
+
+# Given an asyncio stream reader receives one framed message
+# Returns None if the connection closes before a full message arrives
+async def recvFrameAsync(reader):
+    try:
+        header = await reader.readexactly(headerSize)
+        (length,) = headerStruct.unpack(header)
+        if length > maxMessageSize:
+            raise ProtocolError(f"message of {length} bytes exceeds limit")
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        return None
+
+
+# Receives framed messages from a blocking socket using one reusable buffer
+# Several small messages can arrive in a single recv, larger ones are read
+# straight into their own buffer
+class FrameReader:
+    def __init__(self, sock, bufferSize=smallMessageSize):
+        self.sock = sock
+        self.buffer = bytearray(bufferSize)
+        self.view = memoryview(self.buffer)
+        self.start = 0
+        self.end = 0
+
+    # Receives until at least n unread bytes are buffered. Returns False on EOF
+    def fill(self, n):
+        while self.end - self.start < n:
+            # Move unread bytes to the front when there is no room after them
+            if len(self.buffer) - self.start < n:
+                unread = self.end - self.start
+                self.buffer[:unread] = self.buffer[self.start : self.end]
+                self.start = 0
+                self.end = unread
+
+            received = self.sock.recv_into(self.view[self.end :])
+            if received == 0:
+                return False
+            self.end += received
+        return True
+
+    # Receives one message. Returns None if the connection closes first
+    def recvMessage(self):
+        if not self.fill(headerSize):
+            return None
+        (length,) = headerStruct.unpack_from(self.buffer, self.start)
+        self.start += headerSize
+        if length > maxMessageSize:
+            raise ProtocolError(f"message of {length} bytes exceeds limit")
+
+        if length <= len(self.buffer):
+            if not self.fill(length):
+                return None
+            message = bytes(self.view[self.start : self.start + length])
+            self.start += length
+        else:
+            # Copy what is already buffered then receive the rest in place
+            message = bytearray(length)
+            messageView = memoryview(message)
+            received = self.end - self.start
+            messageView[:received] = self.view[self.start : self.end]
+            self.start = self.end
+            while received < length:
+                n = self.sock.recv_into(messageView[received:])
+                if n == 0:
+                    return None
+                received += n
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        return message
+
+
+# Splits bytes read from a non-blocking socket into framed messages
+# Bytes are fed in as they arrive and whole messages taken out once complete
+class FrameDecoder:
+    def __init__(self):
+        self.buffer = bytearray()
+        self.start = 0
+
+    # Given received bytes returns the list of messages they complete
+    def feed(self, data):
+        self.buffer += data
+        messages = []
+        while len(self.buffer) - self.start >= headerSize:
+            (length,) = headerStruct.unpack_from(self.buffer, self.start)
+            if length > maxMessageSize:
+                raise ProtocolError(f"message of {length} bytes exceeds limit")
+            end = self.start + headerSize + length
+            if end > len(self.buffer):
+                break
+            messages.append(bytes(self.buffer[self.start + headerSize : end]))
+            self.start = end
+
+        # Drop consumed bytes once they are most of the buffer
+        if self.start > 0 and self.start * 2 >= len(self.buffer):
+            del self.buffer[: self.start]
+            self.start = 0
+        return messages
+
+
+"""
+    Binary protocol. Negotiated during login for machine to machine use, after
+    which every request and reply is a binary message inside the usual frame.
+
+    Request: opcode byte, varint requestId (0 if untagged), varint field count,
+             each field as varint length + bytes, then any body bytes (UED data)
+    Reply:   opcode byte, varint requestId, status byte (0 = RC0, 1 = RC1),
+             payload type byte, then the payload
+    Push:    a PSH reply with requestId 0, sent unprompted to subscribed sessions
+"""
+
+# Token sent after the username and UDP port to request the binary protocol,
+# and the welcome message when the server accepts it
+binaryProtocolToken = "binary"
+binaryWelcome = "welcome binary"
+
+opcodes = {
+    "AED": 1,
+    "EDG": 2,
+    "DTE": 3,
+    "SCS": 4,
+    "UED": 5,
+    "OUT": 6,
+    "BAT": 7,
+    "LKP": 8,
+    "PSH": 9,
+    "SUB": 10,
+    "STA": 11,
+    "LST": 12,
+    "ERR": 15,
+}
+opcodeCommands = {opcode: command for command, opcode in opcodes.items()}
+
+# Reply payload types
+payloadText = 0
+payloadInt = 1
+payloadFloat = 2
+payloadList = 3
+
+floatStruct = struct.Struct("!d")
+
+
+# Given a non-negative integer returns its LEB128 varint encoding
+def encodeVarint(n):
+    encoded = bytearray()
+    while n >= 0x80:
+        encoded.append((n & 0x7F) | 0x80)
+        n >>= 7
+    encoded.append(n)
+    return bytes(encoded)
+
+
+# Given bytes and a position decodes a varint. Returns the value and next position
+def decodeVarint(data, position):
+    n = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise ProtocolError("truncated varint")
+        byte = data[position]
+        position += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, position
+        shift += 7
+
+
+# Given bytes and a position decodes a varint length then that many bytes
+def decodeField(data, position):
+    length, position = decodeVarint(data, position)
+    if position + length > len(data):
+        raise ProtocolError("truncated field")
+    return bytes(data[position : position + length]), position + length
+
+
+# Given a command name, request ID, list of field bytes and body returns the request
+def encodeBinaryRequest(command, requestId, fields, body=b""):
+    parts = [
+        bytes([opcodes[command]]),
+        encodeVarint(requestId),
+        encodeVarint(len(fields)),
+    ]
+    for field in fields:
+        parts.append(encodeVarint(len(field)))
+        parts.append(field)
+    parts.append(body)
+    return b"".join(parts)
+
+
+# Given a request returns (command, requestId, fields, body)
+# Command is None if the opcode is unknown
+def decodeBinaryRequest(data):
+    if len(data) == 0:
+        raise ProtocolError("empty request")
+    command = opcodeCommands.get(data[0])
+    requestId, position = decodeVarint(data, 1)
+    nFields, position = decodeVarint(data, position)
+    fields = []
+    for i in range(nFields):
+        field, position = decodeField(data, position)
+        fields.append(field)
+    return command, requestId, fields, bytes(data[position:])
+
+
+# Given a command name, request ID, status and value returns the reply
+# Value is sent as an integer, float, list of nested replies or text by its type
+def encodeBinaryReply(command, requestId, status, value):
+    header = bytes([opcodes[command]]) + encodeVarint(requestId) + bytes([status])
+    if isinstance(value, bool) or isinstance(value, str):
+        return header + bytes([payloadText]) + str(value).encode()
+    if isinstance(value, int):
+        # Zigzag so negative numbers stay short
+        zigzag = value << 1 if value >= 0 else ((-value) << 1) - 1
+        return header + bytes([payloadInt]) + encodeVarint(zigzag)
+    if isinstance(value, float):
+        return header + bytes([payloadFloat]) + floatStruct.pack(value)
+    parts = [header, bytes([payloadList]), encodeVarint(len(value))]
+    for reply in value:
+        parts.append(encodeVarint(len(reply)))
+        parts.append(reply)
+    return b"".join(parts)
+
+
+# Given a reply returns (command, requestId, status, value)
+# Value is a str, int, float or list of nested reply bytes
+def decodeBinaryReply(data):
+    if len(data) < 3:
+        raise ProtocolError("truncated reply")
+    command = opcodeCommands.get(data[0])
+    requestId, position = decodeVarint(data, 1)
+    if position + 2 > len(data):
+        raise ProtocolError("truncated reply")
+    status = data[position]
+    payloadType = data[position + 1]
+    position += 2
+
+    if payloadType == payloadText:
+        value = bytes(data[position:]).decode()
+    elif payloadType == payloadInt:
+        zigzag, position = decodeVarint(data, position)
+        value = zigzag >> 1 if zigzag & 1 == 0 else -((zigzag + 1) >> 1)
+    elif payloadType == payloadFloat:
+        (value,) = floatStruct.unpack_from(data, position)
+    elif payloadType == payloadList:
+        nReplies, position = decodeVarint(data, position)
+        value = []
+        for i in range(nReplies):
+            reply, position = decodeField(data, position)
+            value.append(reply)
+    else:
+        raise ProtocolError(f"unknown payload type {payloadType}")
+    return command, requestId, status, value
+
+
+"""
+    Compression. Requested during login by adding "compress=METHOD" after the
+    username and UDP port, and accepted by the server repeating it after its
+    welcome. UED file data is then sent compressed in either protocol.
+"""
+
+compressionToken = "compress"
+compressionMethods = ["zlib", "lzma"]
+defaultCompressionLevel = 6
+
+
+# Given a compression method, data bytes and level 0-9 returns the compressed data
+def compressBody(method, data, level=defaultCompressionLevel):
+    if method == "zlib":
+        return zlib.compress(data, level)
+    return lzma.compress(data, preset=level)
+
+
+# Given a compression method and compressed bytes returns the original data
+# Raises ProtocolError if the data is damaged or expands beyond maxSize
+def decompressBody(method, data, maxSize=maxMessageSize):
+    if method == "zlib":
+        decompressor = zlib.decompressobj()
+    else:
+        decompressor = lzma.LZMADecompressor()
+    try:
+        body = decompressor.decompress(data, maxSize)
+    except (zlib.error, lzma.LZMAError) as error:
+        raise ProtocolError(f"compressed data is damaged: {error}")
+    if not decompressor.eof:
+        raise ProtocolError("compressed data is truncated or too large")
+    return body
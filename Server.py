@@ -1,24 +1,42 @@
 """
-    Usage: python3 server.py localhost 12000
+    Usage: python3 server.py 12000 3 [--mode=threaded|asyncio]
 
     Adapted from example multi-threaded server code on course homepage
 
     By Sam Thorley (z5257239)
 """
 from datetime import datetime
+from collections import OrderedDict
 from socket import *
-from threading import Thread, Lock
-import sys, time, os, re
+from threading import Thread, Lock, Event, get_ident
+import sys, time, os, re, asyncio, heapq, atexit, warnings, queue, signal
+from Protocol import sendFrame, headerStruct, FrameReader, recvFrameAsync, ProtocolError
+from Protocol import headerSize
+from Protocol import binaryProtocolToken, binaryWelcome, opcodes, opcodeCommands
+from Protocol import decodeBinaryRequest, encodeBinaryReply
+from Protocol import compressionToken, compressionMethods, decompressBody
+
+# NumPy is optional, used to parse SCS data files faster when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 """
     Data structs & Global variables
 """
 
-blockedAccounts = set()
+# Username -> monotonic time its block expires, plus a heap of (expiry, username)
+# used to sweep out expired blocks lazily
+blockedAccounts = {}
+blockExpiryHeap = []
 blockedAccountsLock = Lock()
-devicesInfo = {}
-nDevices = 0
-nDevicesLock = Lock()
+blockDuration = 10
+# Username -> password index of the credentials file, and the (mtime, size)
+# of the file when it was loaded
+credentials = {}
+credentialsStamp = None
+credentialsLock = Lock()
 
 """
     File names
@@ -26,22 +44,101 @@ nDevicesLock = Lock()
 
 credentialsFileName = "credentials.txt"
 edgeDeviceLogFileName = "edge-device-log.txt"
+edgeDeviceJournalFileName = "edge-device-journal.txt"
 deletionLogFileName = "deletion-log.txt"
 uploadLogFileName = "upload-log.txt"
+# Device data files are stored as DATA_DIRECTORY/USERNAME/FILEID.txt
+dataDirectoryName = "data"
+# Catalog of the data files, kept in the data directory
+catalogFileName = "catalog.txt"
+# Seconds a recorded modified time may differ from the file's, as the catalog
+# keeps them to the microsecond
+catalogTimeTolerance = 1e-5
+# Files the server keeps in its working directory, never device data
+serverFileNames = [
+    credentialsFileName,
+    edgeDeviceLogFileName,
+    edgeDeviceJournalFileName,
+    deletionLogFileName,
+    uploadLogFileName,
+]
 
 """
     Server setup
 """
 
 # Acquire server port and max fail attempts from command line parameter
-if len(sys.argv) != 3:
-    print("\nError usage: python3 server.py SERVER_PORT NUM_CONSECUTIVE_FAIL_ATTEMPTS")
+if len(sys.argv) < 3:
+    print(
+        "\nError usage: python3 server.py SERVER_PORT NUM_CONSECUTIVE_FAIL_ATTEMPTS [--option=value ...]"
+    )
     exit(0)
 serverHost = "127.0.0.1"
 serverPort = int(sys.argv[1])
 maxFailAttempts = int(sys.argv[2])
 serverAddress = (serverHost, serverPort)
 
+# Optional settings supplied after the required parameters as --name=value
+serverOptions = {}
+for arg in sys.argv[3:]:
+    if not re.match("^--[a-z-]+=.+$", arg):
+        print(f"\nError usage: unrecognised option {arg}, expected --name=value")
+        exit(0)
+    optionName, optionValue = arg[2:].split("=", 1)
+    serverOptions[optionName] = optionValue
+
+# Server mode. 'threaded' runs one thread per connection, 'asyncio' runs every
+# connection as a coroutine on a single event loop
+serverMode = serverOptions.get("mode", "threaded")
+if serverMode not in ["threaded", "asyncio"]:
+    print("\nError usage: --mode must be one of [threaded, asyncio]")
+    exit(0)
+
+# Number of files whose SCS aggregates are kept in memory
+try:
+    scsCacheSize = int(serverOptions.get("scs-cache-size", 1024))
+except ValueError:
+    scsCacheSize = -1
+if scsCacheSize < 0:
+    print("\nError usage: --scs-cache-size must be a non-negative integer")
+    exit(0)
+
+# Whether data files are fsynced before they replace the previous version
+dataFsync = serverOptions.get("data-fsync", "off")
+if dataFsync not in ["on", "off"]:
+    print("\nError usage: --data-fsync must be one of [on, off]")
+    exit(0)
+
+# Whether USERNAME-FILEID.txt files left in the working directory by older
+# versions are moved into the data directory on startup. Off by default as
+# clients run from the same directory keep their UED files there
+migrateLegacy = serverOptions.get("migrate-legacy", "off")
+if migrateLegacy not in ["on", "off"]:
+    print("\nError usage: --migrate-legacy must be one of [on, off]")
+    exit(0)
+
+# Whether log files are fsynced after each group of records is written
+logFsync = serverOptions.get("log-fsync", "off")
+if logFsync not in ["on", "off"]:
+    print("\nError usage: --log-fsync must be one of [on, off]")
+    exit(0)
+
+# Whether clients may send UED data compressed when they ask to during login
+serverCompression = serverOptions.get("compression", "on")
+if serverCompression not in ["on", "off"]:
+    print("\nError usage: --compression must be one of [on, off]")
+    exit(0)
+
+# File the server statistics are written to every statsInterval seconds, if given
+statsFileName = serverOptions.get("stats-file")
+try:
+    statsInterval = float(serverOptions.get("stats-interval", 10))
+except ValueError:
+    statsInterval = 0
+if statsInterval <= 0:
+    print("\nError usage: --stats-interval must be a positive number of seconds")
+    exit(0)
+
 if maxFailAttempts < 1 or maxFailAttempts > 5:
     print(
         "\nError usage: NUM_CONSECUTIVE_FAIL_ATTEMPTS must be between 1 and 5 (inclusive)"
@@ -56,6 +153,9 @@ serverSocket.bind(serverAddress)
 if os.path.exists(edgeDeviceLogFileName):
     os.remove(edgeDeviceLogFileName)
 
+if os.path.exists(edgeDeviceJournalFileName):
+    os.remove(edgeDeviceJournalFileName)
+
 if os.path.exists(deletionLogFileName):
     os.remove(deletionLogFileName)
 
@@ -63,130 +163,299 @@ if os.path.exists(deletionLogFileName):
     Helper functions
 """
 
-# Given a usernamelooks for it in credentials file
+
+# Gives devices dense sequence numbers 1..n in order of joining
+# Each device owns a slot in a Fenwick tree marking occupied slots, so its
+# sequence number is the count of occupied slots up to its own. Joining,
+# leaving and looking up a sequence number are all O(log n)
+class DeviceSequence:
+    def __init__(self, capacity=16):
+        # Device name -> slot, in order of joining
+        self.slots = {}
+        self.nextSlot = 1
+        self.renumber(capacity)
+
+    def __len__(self):
+        return len(self.slots)
+
+    # Reassigns slots 1..n to the current devices in order and rebuilds the tree
+    # Used once all slots have been handed out, which happens at most once per
+    # capacity - n joins so its cost is O(1) amortised
+    def renumber(self, capacity):
+        nDevices = len(self.slots)
+        self.capacity = capacity
+        self.tree = [0] * (capacity + 1)
+        for slot in range(1, capacity + 1):
+            # Node covers slots (slot - lowbit, slot], of which 1..nDevices are occupied
+            lowestSlot = slot - (slot & -slot)
+            self.tree[slot] = max(0, min(slot, nDevices) - lowestSlot)
+
+        for slot, deviceName in enumerate(list(self.slots), 1):
+            self.slots[deviceName] = slot
+        self.nextSlot = nDevices + 1
+
+    # Given a slot adds delta to its occupancy
+    def update(self, slot, delta):
+        while slot <= self.capacity:
+            self.tree[slot] += delta
+            slot += slot & -slot
+
+    # Given a device name appends it to the end of the sequence
+    def add(self, deviceName):
+        if self.nextSlot > self.capacity:
+            self.renumber(max(16, 2 * (len(self.slots) + 1)))
+        slot = self.nextSlot
+        self.nextSlot += 1
+        self.slots[deviceName] = slot
+        self.update(slot, 1)
+
+    # Given a device name removes it, shifting later devices down by 1
+    def remove(self, deviceName):
+        self.update(self.slots.pop(deviceName), -1)
+
+    # Given a device name returns its sequence number
+    def seqNum(self, deviceName):
+        slot = self.slots[deviceName]
+        total = 0
+        while slot > 0:
+            total += self.tree[slot]
+            slot -= slot & -slot
+        return total
+
+
+# Active edge devices. Writers take the lock, readers use immutable snapshots
+# which are rebuilt only when the registry version changes
+class DeviceRegistry:
+    def __init__(self):
+        self.lock = Lock()
+        # Device name -> device object. Device objects are never modified once added
+        self.devices = {}
+        self.sequence = DeviceSequence()
+        self.version = 0
+
+        # Snapshot of (deviceName, deviceObj) in seqNum order and the version it is from
+        self.snapshot = ()
+        self.snapshotVersion = 0
+
+        # (version, listing, spans) holding the pre-rendered AED listing of every
+        # device and each device's span within it. Replaced whole on rebuild
+        self.listingCache = (0, "", {})
+
+        # Sessions subscribed to device join and leave events with SUB
+        self.subscribers = set()
+
+    def __contains__(self, deviceName):
+        return deviceName in self.devices
+
+    def __len__(self):
+        return len(self.devices)
+
+    # Given a device name and object adds it to the end of the sequence
+    # Returns its seqNum, or None if a device with that name is already active
+    def add(self, deviceName, deviceObj):
+        self.lock.acquire()
+        if deviceName in self.devices:
+            self.lock.release()
+            return None
+        self.sequence.add(deviceName)
+        self.devices[deviceName] = deviceObj
+        self.version += 1
+        deviceSeqNum = self.sequence.seqNum(deviceName)
+        self.queueEvent(joinEvent(deviceName, deviceObj))
+        self.lock.release()
+        return deviceSeqNum
+
+    # Given a device name removes it. Returns False if it was not active
+    def remove(self, deviceName):
+        self.lock.acquire()
+        if deviceName not in self.devices:
+            self.lock.release()
+            return False
+        # Later device sequence numbers shift down by 1
+        self.sequence.remove(deviceName)
+        self.devices.pop(deviceName)
+        self.version += 1
+        self.queueEvent(f"leave {deviceName}")
+        self.lock.release()
+        return True
+
+    # Given an event queues it for every subscribed session. Called holding the
+    # lock, so subscribers receive events in the order the registry changed
+    def queueEvent(self, event):
+        for session in self.subscribers:
+            session.queuePush(event)
+
+    # Given a session subscribes it to device join and leave events, first
+    # queueing a join for every other active device
+    # Returns the number of other active devices
+    def subscribe(self, session):
+        self.lock.acquire()
+        self.subscribers.add(session)
+        nOtherDevices = 0
+        for deviceName, deviceObj in self.devices.items():
+            if deviceName != session.username:
+                session.queuePush(joinEvent(deviceName, deviceObj))
+                nOtherDevices += 1
+        self.lock.release()
+        return nOtherDevices
+
+    # Given a session stops sending it device events
+    def unsubscribe(self, session):
+        self.lock.acquire()
+        self.subscribers.discard(session)
+        self.lock.release()
+
+    # Given a device name returns its device object, or None if it is not active
+    def get(self, deviceName):
+        return self.devices.get(deviceName)
+
+    # Returns a tuple of (deviceName, deviceObj) in seqNum order
+    def getSnapshot(self):
+        if self.snapshotVersion != self.version:
+            self.lock.acquire()
+            if self.snapshotVersion != self.version:
+                self.snapshot = tuple(self.devices.items())
+                self.snapshotVersion = self.version
+            self.lock.release()
+        return self.snapshot
+
+    # Given a device name returns the AED listing of every other device
+    def getListing(self, excludedDeviceName):
+        if self.listingCache[0] != self.version:
+            self.lock.acquire()
+            if self.listingCache[0] != self.version:
+                lines = []
+                spans = {}
+                position = 0
+                for deviceName, deviceObj in self.devices.items():
+                    line = f"\n{deviceName}, active since {deviceObj['timestamp']}, IP address: {deviceObj['deviceIPAddr']}, UDP port number: {deviceObj['UDPPortNum']}"
+                    lines.append(line)
+                    spans[deviceName] = (position, position + len(line))
+                    position += len(line)
+                self.listingCache = (self.version, "".join(lines), spans)
+            self.lock.release()
+
+        version, listing, spans = self.listingCache
+        if excludedDeviceName not in spans:
+            return listing
+        start, end = spans[excludedDeviceName]
+        return listing[:start] + listing[end:]
+
+
+deviceRegistry = DeviceRegistry()
+
+
+# Reloads the credentials index if the credentials file changed since it was loaded
+# The new index is built aside and swapped in whole so lookups never see a partial load
+def refreshCredentials():
+    global credentials, credentialsStamp
+
+    try:
+        credsStat = os.stat(credentialsFileName)
+        stamp = (credsStat.st_mtime_ns, credsStat.st_size)
+    except FileNotFoundError:
+        stamp = None
+
+    if stamp == credentialsStamp:
+        return
+
+    credentialsLock.acquire()
+    # Another thread may have reloaded while waiting for the lock
+    if stamp != credentialsStamp:
+        newCredentials = {}
+        if stamp is not None:
+            credsFile = open(credentialsFileName, "r")
+            for line in credsFile:
+                lineCreds = line.split()
+                # Skip malformed lines, first entry for a username wins
+                if len(lineCreds) >= 2:
+                    newCredentials.setdefault(lineCreds[0], lineCreds[1])
+            credsFile.close()
+
+        credentials = newCredentials
+        credentialsStamp = stamp
+    credentialsLock.release()
+
+
+# Given a username looks for it in credentials index
 def usernameLookup(username):
-    credsFile = open(credentialsFileName, "r")
-    credsLines = credsFile.readlines()
-    credsFile.close()
-    for line in credsLines:
-        lineUsername = line.split()[0]
-        if username == lineUsername:
-            return True
-    return False
+    refreshCredentials()
+    return username in credentials
 
 
-# Given a username and password looks for it in credentials file
+# Given a username and password looks for it in credentials index
 def passwordLookup(username, password):
-    credsFile = open(credentialsFileName, "r")
-    credsLines = credsFile.readlines()
-    credsFile.close()
-    for line in credsLines:
-        lineCreds = line.split()
-        lineUsername = lineCreds[0]
-        linePassword = lineCreds[1]
-        if username == lineUsername:
-            if password == linePassword:
-                return True
-            else:
-                return False
-    return False
+    refreshCredentials()
+    return credentials.get(username) == password
 
 
 # Given a username blocks that account for 10s
+# Only the expiry time is recorded, no thread waits for the block to end
 def blockAccount(username):
+    expiry = time.monotonic() + blockDuration
+
     blockedAccountsLock.acquire()
-    blockedAccounts.add(username)
+    blockedAccounts[username] = expiry
+    heapq.heappush(blockExpiryHeap, (expiry, username))
     blockedAccountsLock.release()
+    metrics.accountLocked()
 
-    time.sleep(10)
 
-    blockedAccountsLock.acquire()
-    blockedAccounts.remove(username)
-    blockedAccountsLock.release()
+# Removes blocks which expired before the given time. blockedAccountsLock must be held
+def sweepBlockedAccounts(now):
+    while len(blockExpiryHeap) > 0 and blockExpiryHeap[0][0] <= now:
+        expiry, username = heapq.heappop(blockExpiryHeap)
+        # A later block of the same account replaces this one
+        if blockedAccounts.get(username) == expiry:
+            blockedAccounts.pop(username)
 
 
 # Given a username checks if that account is currently blocked
 def checkBlocked(username):
     blockedAccountsLock.acquire()
-    if username in blockedAccounts:
-        blockedAccountsLock.release()
-        return True
-    else:
-        blockedAccountsLock.release()
-        return False
-
-
-# Given a string writes it to the edge device log
-def writeToEdgeDeviceLog(logString):
-    edgeDeviceLogFile = open(edgeDeviceLogFileName, "a")
-    edgeDeviceLogFile.write(logString)
-    edgeDeviceLogFile.close()
-
-
-# Writes edge device log based off data in devicesInfo object in order of seqNum
-def createEdgeDeviceLog():
-    # Remove existing log file if exists
-    if os.path.exists(edgeDeviceLogFileName):
-        os.remove(edgeDeviceLogFileName)
-
-    # Create dictionary with seqNum as key and deviceName as value to be used in sort
-    seqNums = {}
-    for deviceName in devicesInfo:
-        seqNums[devicesInfo[deviceName]["deviceSeqNum"]] = deviceName
-
-    # Add devices to log sorted by seqNum
-    for seqNum in sorted(seqNums.keys()):
-        deviceObj = devicesInfo[seqNums[seqNum]]
-        timestamp = deviceObj["timestamp"]
-        username = seqNums[seqNum]
-        deviceIPAddr = deviceObj["deviceIPAddr"]
-        UDPPortNum = deviceObj["UDPPortNum"]
-
-        logString = f"{seqNum}; {timestamp}; {username}; {deviceIPAddr}; {UDPPortNum}\n"
-        writeToEdgeDeviceLog(logString)
+    sweepBlockedAccounts(time.monotonic())
+    blocked = username in blockedAccounts
+    blockedAccountsLock.release()
+    return blocked
 
 
 # Add new device to network
-# Intialises device information in global struct and add to log file
+# Intialises device information in the registry and add to log file
+# Returns False if the username is already logged in
 def addNewDevice(username, clientIPAddr, clientUDPPort):
-    nDevicesLock.acquire()
-    global nDevices
-    nDevices += 1
-    deviceSeqNum = nDevices
-    nDevicesLock.release()
-
     timestamp = getFormattedDatetime(datetime.now())
     UDPPortNum = clientUDPPort
 
-    # Add device to devices object
+    # Add device to registry
     deviceObj = {}
     deviceObj["timestamp"] = timestamp
-    deviceObj["deviceSeqNum"] = deviceSeqNum
     deviceObj["deviceIPAddr"] = clientIPAddr
     deviceObj["UDPPortNum"] = UDPPortNum
-    devicesInfo[username] = deviceObj
+    deviceSeqNum = deviceRegistry.add(username, deviceObj)
+    if deviceSeqNum is None:
+        return False
 
     # Update edge device log
-    createEdgeDeviceLog()
+    edgeDeviceLog.appendRecord(
+        f"join; {deviceSeqNum}; {timestamp}; {username}; {clientIPAddr}; {UDPPortNum}\n"
+    )
+    return True
 
 
 # Remove device from network
 def removeDevice(usernameToRemove):
-    nDevicesLock.acquire()
-    global nDevices
-    nDevices -= 1
-    nDevicesLock.release()
+    if not deviceRegistry.remove(usernameToRemove):
+        return
 
-    seqNumToRemove = devicesInfo[usernameToRemove]["deviceSeqNum"]
+    # Update edge device log
+    timestamp = getFormattedDatetime(datetime.now())
+    edgeDeviceLog.appendRecord(f"leave; {timestamp}; {usernameToRemove}\n")
 
-    devicesInfo.pop(usernameToRemove)
-    for deviceName in devicesInfo:
-        if devicesInfo[deviceName]["deviceSeqNum"] > seqNumToRemove:
-            # Shift device sequence numbers down by 1
-            devicesInfo[deviceName]["deviceSeqNum"] -= 1
 
-    # Recreate edge log file
-    createEdgeDeviceLog()
+# Given a device name and object returns the event pushed when it joins
+# Events are 'join deviceName IPAddress UDPPort' and 'leave deviceName'
+def joinEvent(deviceName, deviceObj):
+    return f"join {deviceName} {deviceObj['deviceIPAddr']} {deviceObj['UDPPortNum']}"
 
 
 # Given a datetime timestamp converts to format "DD Month YYYY HH:MM:SS"
@@ -195,357 +464,1672 @@ def getFormattedDatetime(ts):
 
 
 """
-    Main thread for clients. One is created for each connection received.
+    SCS computation engine. Data files are streamed in large chunks and each
+    chunk of lines is reduced to an aggregate of (count, total, minimum, maximum)
+    of its integer lines, so memory use does not grow with file size.
 """
 
+# Bytes read from a data file at a time
+computationChunkSize = 4 * 1024 * 1024
 
-class ClientThread(Thread):
-    def __init__(self, clientAddress, clientSocket):
-        Thread.__init__(self)
-        self.clientAddress = clientAddress
-        self.clientSocket = clientSocket
-        self.clientAlive = False
-        self.authenticated = False
-        self.username = ""
+# Aggregate of a file with no integer lines
+emptyAggregate = (0, 0, None, None)
 
-        print("===== New connection created for: ", self.clientAddress)
-        self.clientAlive = True
+# Lines longer than this could overflow NumPy's int64
+maxNumpyLineLength = 18
 
-    def run(self):
-        # Variable used to store message to send/receive
-        message = ""
+# NumPy warns when it stops early on a line it cannot parse, the Python path then handles it
+warnings.filterwarnings(
+    "ignore", "string or file could not be read to its end", DeprecationWarning
+)
 
-        while self.clientAlive:
-            if not self.authenticated:
-                self.promptLogin()
 
-                # If still not authenticated user reached maximum fail limit
-                if not self.authenticated:
-                    self.clientAlive = False
-                    print("===== user killed - ", self.clientAddress)
+# Given two aggregates returns the aggregate of both
+def mergeAggregates(first, second):
+    if first[0] == 0:
+        return second
+    if second[0] == 0:
+        return first
+    return (
+        first[0] + second[0],
+        first[1] + second[1],
+        min(first[2], second[2]),
+        max(first[3], second[3]),
+    )
+
+
+# Given a block of complete lines returns its aggregate using NumPy
+# Returns None unless every line is a plain integer, leaving other blocks to the
+# Python path so non-integer lines are skipped exactly as before
+def aggregateLinesNumpy(block):
+    # Only digits, '-' at the start of a line, and '\r' before a line end allowed
+    if block.translate(None, b"0123456789-\r\n") != b"":
+        return None
+    if block.count(b"\r") != block.count(b"\r\n") + block.endswith(b"\r"):
+        return None
+    if block.count(b"-") != block.count(b"\n-") + block.startswith(b"-"):
+        return None
+    # NumPy reads a lone '-' or '\r' as 0
+    if b"-\n" in block or b"-\r" in block or block.endswith(b"-"):
+        return None
+    if b"\n\r" in block or block.startswith(b"\r"):
+        return None
+
+    lineEnds = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == 10)
+    lineStarts = numpy.concatenate(([0], lineEnds + 1))
+    lineEnds = numpy.append(lineEnds, len(block))
+    if (lineEnds - lineStarts).max() > maxNumpyLineLength:
+        return None
+
+    values = numpy.fromstring(block, dtype=numpy.int64, sep="\n")
+    # Blank lines parse to nothing, so a short result means fall back
+    if len(values) != len(lineEnds):
+        return None
+
+    minimum = int(values.min())
+    maximum = int(values.max())
+    # Sum in int64 only when it cannot overflow
+    if max(abs(minimum), abs(maximum)) * len(values) < 2**63:
+        total = int(values.sum())
+    else:
+        total = sum(values.tolist())
+    return (len(values), total, minimum, maximum)
+
+
+# Given a block of complete lines returns the aggregate of its integer lines
+def aggregateLines(block):
+    if numpy is not None:
+        aggregate = aggregateLinesNumpy(block)
+        if aggregate is not None:
+            return aggregate
+
+    lines = block.split(b"\n")
+    try:
+        values = list(map(int, lines))
+    except ValueError:
+        values = []
+        for line in lines:
+            try:
+                values.append(int(line))
+            except ValueError:
+                # Skip line if not integer
+                continue
+
+    if len(values) == 0:
+        return emptyAggregate
+    return (len(values), sum(values), min(values), max(values))
+
+
+# Given a file name streams the file and returns the aggregate of its integer lines
+def computeFileAggregate(fileName):
+    aggregate = emptyAggregate
+    remainder = b""
+
+    dataFile = open(fileName, "rb")
+    while True:
+        chunk = dataFile.read(computationChunkSize)
+        if chunk == b"":
+            break
+        if remainder != b"":
+            chunk = remainder + chunk
+
+        # Hold back the last partial line until the next chunk completes it
+        lastNewline = chunk.rfind(b"\n")
+        if lastNewline == -1:
+            remainder = chunk
+            continue
+        aggregate = mergeAggregates(aggregate, aggregateLines(chunk[:lastNewline]))
+        remainder = chunk[lastNewline + 1 :]
+    dataFile.close()
+
+    if remainder != b"":
+        aggregate = mergeAggregates(aggregate, aggregateLines(remainder))
+    return aggregate
+
+
+# Bounded cache of file aggregates keyed by (username, fileID), evicting the
+# least recently used. Files only change through EDG, UED and DTE, which fill or
+# invalidate their entry. A username has one session at a time, so its files are
+# never written while one of its SCS commands is computing
+class AggregateCache:
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = Lock()
+
+    # Given a key returns its aggregate, or None if not cached
+    def get(self, key):
+        self.lock.acquire()
+        aggregate = self.entries.get(key)
+        if aggregate is not None:
+            self.entries.move_to_end(key)
+        self.lock.release()
+        return aggregate
+
+    # Given a key and aggregate caches it, evicting the oldest entry if full
+    def put(self, key, aggregate):
+        if self.capacity == 0:
+            return
+        self.lock.acquire()
+        self.entries[key] = aggregate
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+        self.lock.release()
+
+    # Given a key drops its aggregate if cached
+    def invalidate(self, key):
+        self.lock.acquire()
+        self.entries.pop(key, None)
+        self.lock.release()
+
+
+aggregateCache = AggregateCache(scsCacheSize)
+
+
+"""
+    Data storage. Each user's files are kept in their own directory under the
+    data directory, with an in-memory index so commands never probe the disk to
+    find a file.
+"""
+
+# Bytes read at a time when counting the samples in an existing file
+sampleCountChunkSize = 1 << 20
+
+
+# Given file bytes returns the number of lines, counting a final line without
+# a trailing new line
+def countSamples(data):
+    if len(data) == 0:
+        return 0
+    return data.count(b"\n") + (0 if data.endswith(b"\n") else 1)
+
+
+# Given a file name returns the number of lines in it without loading it whole
+def countFileSamples(fileName):
+    nSamples = 0
+    lastByte = b"\n"
+    dataFile = open(fileName, "rb")
+    while True:
+        chunk = dataFile.read(sampleCountChunkSize)
+        if chunk == b"":
+            break
+        nSamples += chunk.count(b"\n")
+        lastByte = chunk[-1:]
+    dataFile.close()
+    if lastByte != b"\n":
+        nSamples += 1
+    return nSamples
+
+
+# Given a file's details returns its catalog.txt record
+def catalogRecord(username, fileID, size, nSamples, created, modified):
+    return f"PUT {username} {fileID} {size} {nSamples} {created:.6f} {modified:.6f}\n"
+
+
+# Stores device data files as DIRECTORY/USERNAME/FILEID.txt and keeps a catalog
+# of them, username -> fileID -> (path, size, nSamples, created, modified)
+# Files are written under a temporary name and renamed into place, so a file is
+# either its old or new version even if the server stops part way through
+# Catalog changes are appended to DIRECTORY/catalog.txt by the log writer, so on
+# restart files are only read again if they changed after their last record
+class DataStore:
+    def __init__(self, directory, fsync):
+        self.directory = directory
+        self.fsync = fsync
+        self.catalogFileName = os.path.join(directory, catalogFileName)
+        self.catalog = {}
+        self.lock = Lock()
+        # User directories known to exist
+        self.userDirectories = set()
+
+    # Given a username and fileID returns the file's path
+    # Returns None if the fileID could reach outside the user's directory, cannot
+    # be written to the catalog or is made of digits which are not decimal
+    def filePath(self, username, fileID):
+        if fileID == "" or "/" in fileID or "\\" in fileID or fileID.startswith("."):
+            return None
+        if re.search("\\s", fileID):
+            return None
+        # Numeric fileIDs are sorted as numbers, so digits must be decimal ones
+        if fileID.isdigit() and not fileID.isdecimal():
+            return None
+        return os.path.join(self.directory, username, f"{fileID}.txt")
+
+    # Given a username and fileID returns (path, size, nSamples, created,
+    # modified), or None if the file does not exist
+    def lookup(self, username, fileID):
+        return self.catalog.get(username, {}).get(fileID)
+
+    # Given a username returns a list of (fileID, entry) for their files
+    def listFiles(self, username):
+        self.lock.acquire()
+        files = list(self.catalog.get(username, {}).items())
+        self.lock.release()
+        return files
+
+    # Given a username, fileID, function writing a file at a given path and the
+    # number of samples written, stores the file
+    # Returns False if the fileID is not valid
+    def write(self, username, fileID, writeFunction, nSamples):
+        path = self.filePath(username, fileID)
+        if path is None:
+            return False
+
+        if username not in self.userDirectories:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.userDirectories.add(username)
+
+        # Named per thread so two sessions writing the same file do not collide
+        tempPath = f"{path}.{get_ident()}.tmp"
+        writeFunction(tempPath)
+        if self.fsync:
+            tempFile = open(tempPath, "rb")
+            os.fsync(tempFile.fileno())
+            tempFile.close()
+        os.replace(tempPath, path)
+
+        # Modified time is the file's own, so load can tell if it changed later
+        fileStat = os.stat(path)
+        size = fileStat.st_size
+        modified = fileStat.st_mtime
+        self.lock.acquire()
+        userFiles = self.catalog.setdefault(username, {})
+        # Overwriting a file keeps when it was first created
+        previous = userFiles.get(fileID)
+        created = modified if previous is None else previous[3]
+        userFiles[fileID] = (path, size, nSamples, created, modified)
+        logWriter.append(
+            self.catalogFileName,
+            catalogRecord(username, fileID, size, nSamples, created, modified),
+        )
+        self.lock.release()
+        return True
+
+    # Given a username, fileID and data bytes stores the data as the file
+    # Returns False if the fileID is not valid
+    def writeData(self, username, fileID, data):
+        def writeFunction(path):
+            dataFile = open(path, "wb")
+            dataFile.write(data)
+            dataFile.close()
+
+        return self.write(username, fileID, writeFunction, countSamples(data))
+
+    # Given a username and fileID deletes the file
+    # Returns its catalog entry, or None if it did not exist
+    def remove(self, username, fileID):
+        self.lock.acquire()
+        entry = self.catalog.get(username, {}).pop(fileID, None)
+        if entry is not None:
+            logWriter.append(self.catalogFileName, f"DEL {username} {fileID}\n")
+        self.lock.release()
+        if entry is not None:
+            os.remove(entry[0])
+        return entry
+
+    # Builds the catalog from catalog.txt and the files in the data directory,
+    # first moving in any files left in the working directory as
+    # USERNAME-FILEID.txt by older versions if migrateLegacy is set. The catalog
+    # is then rewritten with one record per file
+    def load(self, migrateLegacy):
+        os.makedirs(self.directory, exist_ok=True)
+        if migrateLegacy:
+            self.migrateLegacyFiles()
+        recorded = self.readCatalog()
+
+        nCounted = 0
+        for username in os.listdir(self.directory):
+            userDirectory = os.path.join(self.directory, username)
+            if not os.path.isdir(userDirectory):
+                continue
+            self.userDirectories.add(username)
+            for fileName in os.listdir(userDirectory):
+                path = os.path.join(userDirectory, fileName)
+                if fileName.endswith(".tmp"):
+                    # Left by a write which never finished
+                    os.remove(path)
+                    continue
+                if not fileName.endswith(".txt"):
+                    continue
+
+                fileID = fileName[:-4]
+                fileStat = os.stat(path)
+                size = fileStat.st_size
+                modified = fileStat.st_mtime
+                entry = recorded.get((username, fileID))
+                # A record is only trusted if the file still has its size and
+                # modified time. The record of a rewrite may be lost in a crash
+                if (
+                    entry is None
+                    or entry[0] != size
+                    or abs(entry[3] - modified) > catalogTimeTolerance
+                ):
+                    # Changed since its last record, or written before the catalog
+                    created = modified if entry is None else entry[2]
+                    entry = (size, countFileSamples(path), created, modified)
+                    nCounted += 1
+                self.catalog.setdefault(username, {})[fileID] = (path,) + entry
+
+        self.writeCatalog()
+        nFiles = sum(len(userFiles) for userFiles in self.catalog.values())
+        print(f"===== Catalog has {nFiles} data files, {nCounted} read to update it")
+
+    # Returns the catalog records in catalog.txt as
+    # (username, fileID) -> (size, nSamples, created, modified)
+    def readCatalog(self):
+        recorded = {}
+        if not os.path.exists(self.catalogFileName):
+            return recorded
+        recordFile = open(self.catalogFileName, "r")
+        for line in recordFile:
+            fields = line.split()
+            try:
+                if len(fields) == 7 and fields[0] == "PUT":
+                    recorded[(fields[1], fields[2])] = (
+                        int(fields[3]),
+                        int(fields[4]),
+                        float(fields[5]),
+                        float(fields[6]),
+                    )
+                elif len(fields) == 3 and fields[0] == "DEL":
+                    recorded.pop((fields[1], fields[2]), None)
+            except ValueError:
+                # Partly written record from a crash, the file is read instead
+                continue
+        recordFile.close()
+        return recorded
+
+    # Replaces catalog.txt with one record per file
+    def writeCatalog(self):
+        tempFileName = self.catalogFileName + ".tmp"
+        recordFile = open(tempFileName, "w")
+        for username, userFiles in self.catalog.items():
+            for fileID, (path, size, nSamples, created, modified) in userFiles.items():
+                recordFile.write(
+                    catalogRecord(username, fileID, size, nSamples, created, modified)
+                )
+        recordFile.close()
+        os.replace(tempFileName, self.catalogFileName)
+
+    # Moves USERNAME-FILEID.txt files in the working directory into the data
+    # directory. Usernames may contain '-' so the longest known username wins
+    def migrateLegacyFiles(self):
+        for fileName in os.listdir("."):
+            if not fileName.endswith(".txt") or not os.path.isfile(fileName):
+                continue
+            if fileName in serverFileNames:
+                continue
+            name = fileName[:-4]
+            username = None
+            for position in range(len(name) - 1, 0, -1):
+                if name[position] == "-" and usernameLookup(name[:position]):
+                    username = name[:position]
                     break
+            if username is None:
+                continue
+
+            path = self.filePath(username, name[len(username) + 1 :])
+            if path is None:
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            os.replace(fileName, path)
+            print(f"===== Moved {fileName} to {path}")
+
 
-            # Receive message from the client
-            data = self.clientSocket.recv(1024)
-            message = data.decode()
+"""
+    EDG data generation. Files are written in bounded blocks of numbers so
+    memory use stays flat however much data is requested.
+"""
 
-            # OUT command
-            # Usage: OUT
-            if message == "OUT":
-                print(f"[{self.clientAddress}:recv] OUT")
+# Numbers rendered and written at a time
+generationChunkSize = 1 << 20
+
+
+# Given a start and end returns the bytes of each number in [start, end) on its own line
+# All numbers must have the same number of digits. Digits are rendered column by
+# column with NumPy instead of formatting each number separately
+def renderNumbersNumpy(start, end):
+    values = numpy.arange(start, end, dtype=numpy.int64)
+    nDigits = len(str(start))
+    lines = numpy.empty((end - start, nDigits + 1), dtype=numpy.uint8)
+    lines[:, nDigits] = ord("\n")
+    for column in range(nDigits - 1, -1, -1):
+        lines[:, column] = ord("0") + values % 10
+        values //= 10
+    return lines.tobytes()
+
+
+# Given a start and end returns the bytes of each number in [start, end) on its own line
+def renderNumbers(start, end):
+    if numpy is not None:
+        return renderNumbersNumpy(start, end)
+    return ("\n".join(map(str, range(start, end))) + "\n").encode()
+
+
+# Given a file name and amount writes the numbers 1 to dataAmount to the file,
+# each on a new line without a trailing new line
+def writeSequenceFile(fileName, dataAmount):
+    dataFile = open(fileName, "wb")
+    start = 1
+    while start <= dataAmount:
+        # Blocks never span a change in digit count, as needed by renderNumbersNumpy
+        end = min(start + generationChunkSize, 10 ** len(str(start)), dataAmount + 1)
+        block = renderNumbers(start, end)
+        if end > dataAmount:
+            # Remove trailing new line
+            block = memoryview(block)[:-1]
+        dataFile.write(block)
+        start = end
+    dataFile.close()
 
-                self.sendMessage("RC0;successfully disconnected")
 
-                self.clientAlive = False
-                self.authenticated = False
+"""
+    Metrics
+"""
+
+# Latency histograms have this many buckets per doubling of latency
+latencySubBuckets = 4
+# Enough buckets for latencies up to 2^40 microseconds
+latencyBuckets = 41 * latencySubBuckets
+
+
+# Given a latency in seconds returns its histogram bucket
+# Latency in microseconds is bucketed by its leading 3 bits, so each bucket
+# is at most 25% wide
+def latencyBucket(seconds):
+    micros = int(seconds * 1000000)
+    if micros < latencySubBuckets:
+        return micros
+    exponent = micros.bit_length() - 3
+    return min((exponent << 2) + (micros >> exponent), latencyBuckets - 1)
+
+
+# Given a histogram bucket returns the highest latency in it in milliseconds
+def latencyBucketLimit(bucket):
+    if bucket < latencySubBuckets:
+        return (bucket + 1) / 1000
+    exponent = (bucket >> 2) - 1
+    mantissa = (bucket & 3) + 4
+    return ((mantissa + 1) << exponent) / 1000
+
+
+# Counts commands, their latencies, traffic and logins for the STA command
+# Recording is a few integer updates under one lock
+class ServerMetrics:
+    def __init__(self):
+        self.lock = Lock()
+        self.startTime = time.monotonic()
+        # Command -> count, and command -> latency histogram
+        self.commandCounts = {}
+        self.latencies = {}
+        self.bytesIn = 0
+        self.bytesOut = 0
+        self.activeConnections = 0
+        self.totalConnections = 0
+        self.authFailures = 0
+        self.lockouts = 0
+
+    # Given a command (None for login messages), its run time and message size
+    # records one received message
+    def recordMessage(self, command, seconds, nBytes):
+        bucket = latencyBucket(seconds)
+        self.lock.acquire()
+        self.bytesIn += nBytes
+        if command is not None:
+            if command not in self.commandCounts:
+                self.commandCounts[command] = 0
+                self.latencies[command] = [0] * latencyBuckets
+            self.commandCounts[command] += 1
+            self.latencies[command][bucket] += 1
+        self.lock.release()
+
+    # Given a sent message size records it
+    def recordSent(self, nBytes):
+        self.lock.acquire()
+        self.bytesOut += nBytes
+        self.lock.release()
+
+    def connectionOpened(self):
+        self.lock.acquire()
+        self.activeConnections += 1
+        self.totalConnections += 1
+        self.lock.release()
+
+    def connectionClosed(self):
+        self.lock.acquire()
+        self.activeConnections -= 1
+        self.lock.release()
+
+    def authFailed(self):
+        self.lock.acquire()
+        self.authFailures += 1
+        self.lock.release()
+
+    def accountLocked(self):
+        self.lock.acquire()
+        self.lockouts += 1
+        self.lock.release()
+
+    # Given a histogram and fraction returns the latency below which that
+    # fraction of commands completed, in milliseconds
+    def percentile(self, histogram, count, fraction):
+        target = fraction * count
+        seen = 0
+        for bucket, bucketCount in enumerate(histogram):
+            seen += bucketCount
+            if seen >= target:
+                return latencyBucketLimit(bucket)
+        return latencyBucketLimit(len(histogram) - 1)
+
+    # Returns the statistics as text
+    def render(self):
+        self.lock.acquire()
+        commandCounts = dict(self.commandCounts)
+        latencies = {
+            command: list(histogram) for command, histogram in self.latencies.items()
+        }
+        lines = [
+            f"uptime: {time.monotonic() - self.startTime:.1f}s",
+            f"connections: {self.activeConnections} active, {self.totalConnections} total",
+            f"bytes: {self.bytesIn} in, {self.bytesOut} out",
+            f"logins: {self.authFailures} auth failures, {self.lockouts} lockouts",
+        ]
+        self.lock.release()
+
+        lines.append("command: count, p50, p95, p99 (ms)")
+        for command in sorted(commandCounts):
+            count = commandCounts[command]
+            histogram = latencies[command]
+            p50, p95, p99 = [
+                self.percentile(histogram, count, fraction)
+                for fraction in [0.5, 0.95, 0.99]
+            ]
+            lines.append(f"{command}: {count}, {p50:g}, {p95:g}, {p99:g}")
+        return "\n".join(lines)
+
+
+metrics = ServerMetrics()
+
+
+# Writes the server statistics to statsFileName every statsInterval seconds
+class StatsFileWriter(Thread):
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
 
-                # Remove device
-                removeDevice(self.username)
+    def run(self):
+        while True:
+            time.sleep(statsInterval)
+            self.write()
 
-                print("===== the user disconnected - ", self.clientAddress)
+    def write(self):
+        # Write aside and rename so readers never see a partial file
+        tempFileName = statsFileName + ".tmp"
+        statsFile = open(tempFileName, "w")
+        statsFile.write(metrics.render() + "\n")
+        statsFile.close()
+        os.replace(tempFileName, statsFileName)
+
+
+"""
+    Log writer
+"""
+
+# Waiting records are written once this many bytes have built up, or this many
+# seconds after the first of them was queued
+logFlushBytes = 64 * 1024
+logFlushInterval = 0.05
+
+
+# Appends records to the server's log files from one background thread
+# Handlers queue records and carry on. Records waiting for the same file are
+# written together on a handle kept open for the server's lifetime
+class LogWriter(Thread):
+    def __init__(self, fsync):
+        Thread.__init__(self, daemon=True)
+        self.fsync = fsync
+        self.records = queue.Queue()
+        # File name -> open handle, and file name -> records waiting to be written
+        self.files = {}
+        self.pending = {}
+        self.pendingBytes = 0
+        self.lock = Lock()
+
+    # Given a file name and record string queues the record to be appended
+    def append(self, fileName, record):
+        self.records.put((fileName, record))
+
+    # Given a (fileName, record) pair adds it to the waiting records
+    def addPending(self, item):
+        fileName, record = item
+        if fileName not in self.pending:
+            self.pending[fileName] = []
+        self.pending[fileName].append(record)
+        self.pendingBytes += len(record)
+
+    # Writes every queued and waiting record, then fsyncs if enabled
+    def flush(self):
+        self.lock.acquire()
+        while True:
+            try:
+                self.addPending(self.records.get_nowait())
+            except queue.Empty:
                 break
 
-            # AED command
-            # Usage: AED
-            elif message == "AED":
-                print(f"[{self.clientAddress}:recv] AED")
-                self.activeEdgeDevices()
-
-            # EDG command
-            # Usage: EDG fileID dataAmount
-            elif re.match("^EDG.*", message):
-                args = message.split()
-                if len(args) != 3:
-                    self.sendMessage(
-                        "RC1;EDG resp: \nEDG command requires fileID and dataAmount as arguments."
-                    )
-                else:
-                    fileID = args[1]
-                    dataAmount = args[2]
-                    self.edgeDataGeneration(fileID, dataAmount)
-
-            # DTE command
-            # Usage: DTE fileID
-            elif re.match("^DTE.*", message):
-                args = message.split()
-                if len(args) != 2:
-                    self.sendMessage(
-                        "RC1;DTE resp: \nDTE command requires fileID as argument."
-                    )
-                else:
-                    fileID = args[1]
-                    self.deleteDataFile(fileID)
-
-            # SCS command
-            # Usage: SCS fileID compuationOperation
-            # computationOperation must be one of [AVERAGE, MAX, MIN, SUM]
-            elif re.match("^SCS.*", message):
-                # Ensure correct number of arguments supplied
-                args = message.split()
-                if len(args) != 3:
-                    self.sendMessage(
-                        "RC1;SCS resp: \nSCS command requires fileID and computationOperation as arguments."
-                    )
-                else:
-                    fileID = args[1]
-                    compOp = args[2]
-                    self.serverComputationService(fileID, compOp)
-
-            # UED command
-            # Usage: UED fileID
-            elif re.match("^UED.*", message):
-                # Error handling done on client side in this case
-                args = message.split()
-                fileID = args[1]
+        for fileName, records in self.pending.items():
+            if fileName not in self.files:
+                self.files[fileName] = open(fileName, "a")
+            logFile = self.files[fileName]
+            logFile.write("".join(records))
+            logFile.flush()
+            if self.fsync:
+                os.fsync(logFile.fileno())
+        self.pending = {}
+        self.pendingBytes = 0
+        self.lock.release()
+
+    # Waits for a record, gathers more until the size or time threshold, then writes
+    def run(self):
+        while True:
+            item = self.records.get()
+            self.lock.acquire()
+            self.addPending(item)
+            self.lock.release()
+
+            deadline = time.monotonic() + logFlushInterval
+            while self.pendingBytes < logFlushBytes:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self.records.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                self.lock.acquire()
+                self.addPending(item)
+                self.lock.release()
+
+            self.flush()
+
+
+"""
+    Edge device log
+"""
+
+# Seconds to wait after a join or leave before rewriting the sorted edge device log
+edgeDeviceLogCompactInterval = 1
+
+
+# Appends join and leave records to the edge device journal through the log writer,
+# and in the background compacts the current devices into the edge device log
+# sorted by seqNum
+class EdgeDeviceLogWriter(Thread):
+    def __init__(self):
+        Thread.__init__(self, daemon=True)
+        self.compactLock = Lock()
+        self.changed = Event()
+
+    # Given a record string appends it to the journal and schedules a compaction
+    def appendRecord(self, record):
+        logWriter.append(edgeDeviceJournalFileName, record)
+        self.changed.set()
+
+    # Rewrites the edge device log from a registry snapshot, which is in seqNum order
+    def compact(self):
+        self.compactLock.acquire()
+
+        logLines = []
+        for seqNum, (deviceName, deviceObj) in enumerate(
+            deviceRegistry.getSnapshot(), 1
+        ):
+            logLines.append(
+                f"{seqNum}; {deviceObj['timestamp']}; {deviceName}; {deviceObj['deviceIPAddr']}; {deviceObj['UDPPortNum']}\n"
+            )
+
+        if len(logLines) == 0:
+            # No active devices, no log file
+            if os.path.exists(edgeDeviceLogFileName):
+                os.remove(edgeDeviceLogFileName)
+        else:
+            # Write aside and rename so readers never see a partial log
+            tempFileName = edgeDeviceLogFileName + ".tmp"
+            edgeDeviceLogFile = open(tempFileName, "w")
+            edgeDeviceLogFile.write("".join(logLines))
+            edgeDeviceLogFile.close()
+            os.replace(tempFileName, edgeDeviceLogFileName)
+
+        self.compactLock.release()
+
+    # Compacts at most once per interval however many records arrive
+    def run(self):
+        while True:
+            self.changed.wait()
+            time.sleep(edgeDeviceLogCompactInterval)
+            self.changed.clear()
+            self.compact()
+
+
+"""
+    Client sessions. Holds the per-connection state and runs each command.
+    Transport specific subclasses exist for each server mode.
+"""
+
+# Commands which touch files on the server and so may block
+blockingCommands = ["EDG", "DTE", "SCS", "UED", "BAT"]
+
+# Commands which cannot be run inside a BAT command
+unbatchableCommands = ["OUT", "UED", "BAT", "SUB"]
+
+# Device events a session may have waiting before further events are dropped,
+# and in asyncio mode the bytes waiting to be written to the client
+maxQueuedPushes = 1024
+maxPushBufferBytes = 1 << 20
+
+
+# Given a command message returns its request ID, if tagged, and the command
+# A client pipelining several commands prefixes each with "@ID " and the reply
+# is prefixed with the same tag so it can be matched back to its request
+def splitRequestTag(message):
+    tagMatch = re.match("^@([0-9]+) ", message)
+    if tagMatch is None:
+        return None, message
+    return int(tagMatch.group(1)), message[tagMatch.end() :]
+
+
+class ClientSession:
+    def __init__(self, clientAddress):
+        self.clientAddress = clientAddress
+        self.clientAlive = False
+        self.authenticated = False
+        self.username = ""
+
+        # Login progress, kept between messages until authenticated
+        self.failedAttempts = 0
+        self.validUsername = False
+        self.usernameClaim = ""
+        self.clientUDPPort = 0
+
+        # Request ID of the command being run, and the replies collected while
+        # running a BAT command
+        self.requestId = None
+        self.batchReplies = None
+
+        # Binary protocol is requested with the username and used once logged in
+        self.binaryRequested = False
+        self.binaryMode = False
 
-                # File data is everything after "UED {fileID}\n"
-                # Remove everything before first '\n'
-                fileData = message[(message.find("\n") + 1) :]
-                self.uploadEdgeData(fileID, fileData)
+        # Compression method for UED data, requested with the username like the
+        # binary protocol and used once logged in
+        self.compressionRequested = None
+        self.compression = None
 
-            # Fallback error
-            # Re-request a command
+        # Whether device join and leave events are pushed to this session, and
+        # the events waiting to be pushed
+        self.subscribed = False
+        self.pushQueue = None
+        self.pushesStopped = False
+
+        print("===== New connection created for: ", self.clientAddress)
+        self.clientAlive = True
+        metrics.connectionOpened()
+
+    # Given received message bytes either continues authentication or runs the command
+    def processMessage(self, data):
+        startTime = time.perf_counter()
+        if self.binaryMode:
+            command, self.requestId, fields, body = decodeBinaryRequest(data)
+            self.runBinaryCommand(command, fields, body)
+            self.requestId = None
+            metrics.recordMessage(
+                command or "unknown",
+                time.perf_counter() - startTime,
+                len(data) + headerSize,
+            )
+            return
+
+        # Compressed UED data is not text, so only the line before it is decoded
+        text = data
+        uploadBody = None
+        newline = data.find(b"\n") if self.compression is not None else -1
+        if newline >= 0 and re.match(b"^(@[0-9]+ )?UED", data[:newline]):
+            text = data[:newline]
+            uploadBody = data[newline + 1 :]
+
+        message = text.decode()
+        if not self.authenticated:
+            self.promptLogin(message)
+            metrics.recordMessage(None, 0, len(data) + headerSize)
+
+            # If still not authenticated and login ended user reached maximum fail limit
+            if not self.authenticated and not self.clientAlive:
+                print("===== user killed - ", self.clientAddress)
+            return
+
+        self.requestId, message = splitRequestTag(message)
+        self.runCommand(message, uploadBody)
+        self.requestId = None
+
+        # Unrecognised commands are counted together
+        command = message[0:3]
+        if command not in opcodes:
+            command = "unknown"
+        metrics.recordMessage(
+            command, time.perf_counter() - startTime, len(data) + headerSize
+        )
+
+    # Given a command message from an authenticated client runs the command
+    # UED data still compressed is given separately as uploadBody
+    def runCommand(self, message, uploadBody=None):
+        # OUT command
+        # Usage: OUT
+        if message == "OUT":
+            self.disconnect()
+
+        # AED command
+        # Usage: AED
+        elif message == "AED":
+            print(f"[{self.clientAddress}:recv] AED")
+            self.activeEdgeDevices()
+
+        # EDG command
+        # Usage: EDG fileID dataAmount
+        elif re.match("^EDG.*", message):
+            args = message.split()
+            if len(args) != 3:
+                self.sendResponse(
+                    "EDG", "EDG command requires fileID and dataAmount as arguments."
+                )
             else:
-                print(f"[{self.clientAddress}:recv] " + message)
-                self.sendMessage("RC1;Cannot understand this message")
+                fileID = args[1]
+                dataAmount = args[2]
+                self.edgeDataGeneration(fileID, dataAmount)
+
+        # DTE command
+        # Usage: DTE fileID
+        elif re.match("^DTE.*", message):
+            args = message.split()
+            if len(args) != 2:
+                self.sendResponse("DTE", "DTE command requires fileID as argument.")
+            else:
+                fileID = args[1]
+                self.deleteDataFile(fileID)
+
+        # SCS command
+        # Usage: SCS fileID compuationOperation
+        # computationOperation must be one of [AVERAGE, MAX, MIN, SUM]
+        elif re.match("^SCS.*", message):
+            # Ensure correct number of arguments supplied
+            args = message.split()
+            if len(args) != 3:
+                self.sendResponse(
+                    "SCS",
+                    "SCS command requires fileID and computationOperation as arguments.",
+                )
+            else:
+                fileID = args[1]
+                compOp = args[2]
+                self.serverComputationService(fileID, compOp)
+
+        # UED command
+        # Usage: UED fileID
+        elif re.match("^UED.*", message):
+            # Error handling done on client side in this case
+            args = message.split()
+            fileID = args[1]
+
+            # File data is everything after "UED {fileID}\n"
+            # Remove everything before first '\n'
+            if uploadBody is None:
+                uploadBody = message[(message.find("\n") + 1) :].encode()
+            self.uploadEdgeData(fileID, uploadBody)
+
+        # LKP command
+        # Usage: LKP deviceName
+        elif re.match("^LKP.*", message):
+            args = message.split()
+            if len(args) != 2:
+                self.sendResponse("LKP", "LKP command requires deviceName as argument.")
+            else:
+                self.lookupDevice(args[1])
+
+        # SUB command
+        # Usage: SUB
+        elif message == "SUB":
+            self.subscribeDevices()
+
+        # STA command
+        # Usage: STA
+        elif message == "STA":
+            self.serverStatistics()
+
+        # LST command
+        # Usage: LST
+        elif message == "LST":
+            self.listDataFiles()
+
+        # BAT command
+        # Usage: BAT\ncommand\ncommand...
+        elif re.match("^BAT.*", message):
+            commands = message.split("\n")[1:]
+            self.batchCommands(commands)
+
+        # Fallback error
+        # Re-request a command
+        else:
+            print(f"[{self.clientAddress}:recv] " + message)
+            self.sendError("Cannot understand this message")
+
+    # Given a binary request's command, fields and body runs the command
+    # Commands are dispatched on their opcode with arguments already split
+    def runBinaryCommand(self, command, fields, body):
+        args = [field.decode() for field in fields]
+
+        if command == "OUT":
+            self.disconnect()
+        elif command == "AED":
+            print(f"[{self.clientAddress}:recv] AED")
+            self.activeEdgeDevices()
+        elif command == "EDG" and len(args) == 2:
+            self.edgeDataGeneration(args[0], args[1])
+        elif command == "DTE" and len(args) == 1:
+            self.deleteDataFile(args[0])
+        elif command == "SCS" and len(args) == 2:
+            self.serverComputationService(args[0], args[1])
+        elif command == "UED" and len(args) == 1:
+            self.uploadEdgeData(args[0], body)
+        elif command == "SUB":
+            self.subscribeDevices()
+        elif command == "STA":
+            self.serverStatistics()
+        elif command == "LST":
+            self.listDataFiles()
+        elif command == "LKP" and len(args) == 1:
+            self.lookupDevice(args[0])
+        elif command == "BAT":
+            # Each field is a complete binary request
+            self.batchCommands(fields)
+        elif command in ["EDG", "DTE", "SCS", "UED", "LKP"]:
+            self.sendResponse(command, f"{command} command given wrong arguments.")
+        else:
+            self.sendError("Cannot understand this message")
+
+    # Given received message bytes returns True if handling it may block on file I/O
+    def isBlockingMessage(self, data):
+        if not self.authenticated:
+            return False
+        if self.binaryMode:
+            return len(data) > 0 and opcodeCommands.get(data[0]) in blockingCommands
+        requestId, command = splitRequestTag(data[:32].decode(errors="ignore"))
+        return command[0:3] in blockingCommands
+
+    # Logs the client out and removes its device
+    def disconnect(self):
+        print(f"[{self.clientAddress}:recv] OUT")
+
+        if self.binaryMode:
+            self.sendBinaryReply("OUT", 0, "successfully disconnected")
+        else:
+            self.sendMessage("RC0;successfully disconnected")
+
+        self.clientAlive = False
+        self.authenticated = False
+        self.unsubscribe()
+
+        # Remove device
+        removeDevice(self.username)
+
+        print("===== the user disconnected - ", self.clientAddress)
+
+    # Cleans up after the connection closes, removing the device if the client
+    # disappeared without sending OUT
+    def endSession(self):
+        self.unsubscribe()
+        metrics.connectionClosed()
+        if self.authenticated:
+            self.authenticated = False
+            removeDevice(self.username)
+            print("===== the user connection lost - ", self.clientAddress)
+        self.clientAlive = False
 
     """
         Helper function:
     """
 
     # Given a message outputs to terminal and sends to client
+    # While running a BAT command the message is collected for the batch reply instead
     def sendMessage(self, message):
-        message += "\r"
-        print(f"[{clientAddress}:send] " + message)
-        self.clientSocket.send(message.encode())
+        if self.batchReplies is not None:
+            self.batchReplies.append(message)
+            return
+
+        if self.requestId is not None:
+            message = f"@{self.requestId} " + message
+        print(f"[{self.clientAddress}:send] " + message)
+        self.sendBytes(message.encode())
+
+    # Given a command, status and value sends a binary protocol reply
+    # While running a BAT command the reply is collected for the batch reply instead
+    def sendBinaryReply(self, command, status, value):
+        reply = encodeBinaryReply(command, self.requestId or 0, status, value)
+        if self.batchReplies is not None:
+            self.batchReplies.append(reply)
+            return
+
+        print(f"[{self.clientAddress}:send] {command} {value}")
+        self.sendBytes(reply)
+
+    # Given a command and its response text replies in the session's protocol
+    # In binary mode a value, if given, is sent in place of the text
+    def sendResponse(self, command, text, value=None):
+        if self.binaryMode:
+            self.sendBinaryReply(command, 1, text if value is None else value)
+        else:
+            self.sendMessage(f"RC1;{command} resp: \n{text}")
+
+    # Given an error message replies that the command could not be run
+    def sendError(self, text):
+        if self.binaryMode:
+            self.sendBinaryReply("ERR", 1, text)
+        else:
+            self.sendMessage(f"RC1;{text}")
+
+    # Given a device event sends it to the client unprompted
+    # Text pushes start with '!' so they cannot be mistaken for a reply
+    def sendPush(self, event):
+        if self.binaryMode:
+            data = encodeBinaryReply("PSH", 0, 0, event)
+        else:
+            data = f"!{event}".encode()
+        print(f"[{self.clientAddress}:send] !{event}")
+        try:
+            self.sendBytes(data)
+        except OSError:
+            # Connection is closing, its own thread cleans up
+            return False
+        return True
+
+    # Starts queueing device events for the client, held until releasePushes
+    # Events are queued by whichever thread changes the registry, and sent by a
+    # thread of this session's own so a client which stops reading only holds
+    # up its own events
+    def holdPushes(self):
+        self.pushQueue = queue.Queue(maxQueuedPushes)
+        self.pushesStopped = False
+
+    # Starts delivering queued device events to the client
+    def releasePushes(self):
+        Thread(target=self.deliverPushes, daemon=True).start()
+
+    # Sends queued events until pushes are stopped or the connection fails
+    def deliverPushes(self):
+        while not self.pushesStopped:
+            event = self.pushQueue.get()
+            if event is None or not self.sendPush(event):
+                return
+
+    # Given a device event queues it to be pushed without waiting for the client
+    # The event is dropped if the client has fallen too far behind
+    def queuePush(self, event):
+        try:
+            self.pushQueue.put_nowait(event)
+        except queue.Full:
+            print(f"[{self.clientAddress}:send] dropped !{event}, client not reading")
+
+    # Stops delivering device events
+    def stopPushes(self):
+        self.pushesStopped = True
+        # Wakes the delivering thread if it is waiting. Never blocks, a full queue
+        # means the thread is not waiting and sees pushesStopped before its next get
+        try:
+            self.pushQueue.put_nowait(None)
+        except queue.Full:
+            pass
+
+    # Stops device events being pushed to this session
+    def unsubscribe(self):
+        if self.subscribed:
+            self.subscribed = False
+            deviceRegistry.unsubscribe(self)
+            self.stopPushes()
+
+    # Given encoded data writes it to the client connection as one framed message
+    # May be called from other sessions' threads to push device events
+    def sendBytes(self, data):
+        raise NotImplementedError
 
     """
         Functions to run each command:
     """
 
-    # Authenticate User
-    def promptLogin(self):
-        failedAttempts = 0
-        validUsername = False
-        usernameClaim = ""
-        clientUDPPort = 0
-
-        # Initial get username from client
+    # Request a username from the client to begin authentication
+    def startLogin(self):
         self.sendMessage("RC0;username authentication request")
 
+    # Authenticate User
+    # Given the latest username or password message from the client advances the login
+    def promptLogin(self, message):
         # Validate username
-        while not validUsername:
-            data = self.clientSocket.recv(1024)
-            usernameClaim = data.decode().split()[0]
-            clientUDPPort = data.decode().split()[1]
-
-            if usernameLookup(usernameClaim) and usernameClaim not in devicesInfo:
+        if not self.validUsername:
+            messageArgs = message.split()
+            if len(messageArgs) == 0:
+                self.sendMessage("RC0;retry username authentication request")
+                return
+            self.usernameClaim = messageArgs[0]
+            # UDP Server Port sent with username, kept from an earlier attempt otherwise
+            if len(messageArgs) > 1:
+                self.clientUDPPort = messageArgs[1]
+            # Optional binary protocol and compression requests follow the port
+            if len(messageArgs) > 2:
+                self.binaryRequested = binaryProtocolToken in messageArgs[2:]
+                self.compressionRequested = None
+                for token in messageArgs[2:]:
+                    method = token[len(compressionToken) + 1 :]
+                    if (
+                        token.startswith(f"{compressionToken}=")
+                        and method in compressionMethods
+                        and serverCompression == "on"
+                    ):
+                        self.compressionRequested = method
+            usernameClaim = self.usernameClaim
+
+            if usernameLookup(usernameClaim) and usernameClaim not in deviceRegistry:
                 if not checkBlocked(usernameClaim):
                     # Successful username
-                    validUsername = True
+                    self.validUsername = True
+                    self.sendMessage("RC0;password authentication request")
                 else:
                     # Valid credentials but account blocked
                     self.sendMessage("RC0;blocked account")
-                    return
-            elif usernameClaim in devicesInfo:
+                    self.clientAlive = False
+            elif usernameClaim in deviceRegistry:
                 # Username already logged in
                 self.sendMessage("RC0;username already logged in")
             else:
-                failedAttempts += 1
-                if failedAttempts == maxFailAttempts:
+                self.failedAttempts += 1
+                metrics.authFailed()
+                if self.failedAttempts == maxFailAttempts:
                     # Max failed attempts reached. Block account
                     self.sendMessage("RC0;max failed attempts")
+                    self.clientAlive = False
                     blockAccount(usernameClaim)
                     return
 
                 # Re-request username
                 self.sendMessage("RC0;retry username authentication request")
-
-        # Initial get password from client
-        self.sendMessage("RC0;password authentication request")
+            return
 
         # Validate password
-        while True:
-            data = self.clientSocket.recv(1024)
-            passwordClaim = data.decode()
+        usernameClaim = self.usernameClaim
+        passwordClaim = message
+
+        if passwordLookup(usernameClaim, passwordClaim):
+            if not checkBlocked(usernameClaim):
+                if not addNewDevice(
+                    usernameClaim, self.clientAddress[0], self.clientUDPPort
+                ):
+                    # Another connection logged in with this username first
+                    self.validUsername = False
+                    self.sendMessage("RC0;username already logged in")
+                    return
 
-            if passwordLookup(usernameClaim, passwordClaim):
-                if not checkBlocked(usernameClaim):
-                    # Successful authentication
-                    self.authenticated = True
-                    self.username = usernameClaim
-                    self.sendMessage("RC1;welcome")
-                    addNewDevice(usernameClaim, self.clientAddress[0], clientUDPPort)
-                    break
-                else:
-                    # Valid credentials but account blocked
-                    self.sendMessage("RC0;blocked account")
-                    break
+                # Successful authentication
+                self.authenticated = True
+                self.username = usernameClaim
+                welcome = "welcome"
+                if self.binaryRequested:
+                    welcome = binaryWelcome
+                # Repeating the compression method tells the client it is accepted
+                if self.compressionRequested is not None:
+                    welcome += f" {compressionToken}={self.compressionRequested}"
+                    self.compression = self.compressionRequested
+                self.sendMessage(f"RC1;{welcome}")
+                # Everything after this welcome uses the binary protocol
+                self.binaryMode = self.binaryRequested
             else:
-                failedAttempts += 1
-                if failedAttempts == maxFailAttempts:
-                    # Max failed attempts reached. Block account
-                    self.sendMessage("RC0;max failed attempts")
-                    blockAccount(usernameClaim)
-                    break
+                # Valid credentials but account blocked
+                self.sendMessage("RC0;blocked account")
+                self.clientAlive = False
+        else:
+            self.failedAttempts += 1
+            metrics.authFailed()
+            if self.failedAttempts == maxFailAttempts:
+                # Max failed attempts reached. Block account
+                self.sendMessage("RC0;max failed attempts")
+                self.clientAlive = False
+                blockAccount(usernameClaim)
+                return
 
-                # Re-request credentials
-                self.sendMessage("RC0;retry password authentication request")
+            # Re-request credentials
+            self.sendMessage("RC0;retry password authentication request")
 
     # Return all other active edge devices, excluding requesting client
     def activeEdgeDevices(self):
         print(f"Edge device {self.username} issued AED command")
-        message = "RC1;AED resp: "
 
-        if len(devicesInfo.keys()) == 1:
-            message += "\nno other active edge devices"
+        listing = deviceRegistry.getListing(self.username)
+        if listing == "":
+            message = "no other active edge devices"
         else:
-            for deviceName in devicesInfo:
-                if deviceName == self.username:
-                    continue
-                else:
-                    timestamp = devicesInfo[deviceName]["timestamp"]
-                    ipAddr = devicesInfo[deviceName]["deviceIPAddr"]
-                    udpPortNum = devicesInfo[deviceName]["UDPPortNum"]
-                    message += f"\n{deviceName}, active since {timestamp}, IP address: {ipAddr}, UDP port number: {udpPortNum}"
+            # Remove new line before first device
+            message = listing[1:]
+
+        self.sendResponse("AED", message)
+
+    # Given a device name replies with its IP address and UDP port separated by a space
+    def lookupDevice(self, deviceName):
+        print(f"Edge device {self.username} issued LKP command for {deviceName}")
 
+        deviceObj = deviceRegistry.get(deviceName)
+        if deviceObj is None:
+            message = f"{deviceName} is not active"
+        else:
+            message = f"{deviceObj['deviceIPAddr']} {deviceObj['UDPPortNum']}"
+
+        self.sendResponse("LKP", message)
+
+    # Subscribes the session to device join and leave events
+    # A join event for every other active device follows the reply
+    def subscribeDevices(self):
+        print(f"Edge device {self.username} issued SUB command")
+
+        if self.subscribed:
+            self.sendResponse("SUB", "already subscribed to device events")
+            return
+
+        self.subscribed = True
+        self.holdPushes()
+        # Joins for the devices already active are queued ahead of any later event
+        nOtherDevices = deviceRegistry.subscribe(self)
+        self.sendResponse(
+            "SUB",
+            f"subscribed to device events, {nOtherDevices} other active edge devices",
+        )
+        # Events follow the reply
+        self.releasePushes()
+
+    # Replies with the server statistics
+    def serverStatistics(self):
+        print(f"Edge device {self.username} issued STA command")
+        self.sendResponse("STA", metrics.render())
+
+    # Replies with the user's data files from the catalog, one per line as
+    # fileID; samples; bytes; created; modified
+    def listDataFiles(self):
+        print(f"Edge device {self.username} issued LST command")
+        files = dataStore.listFiles(self.username)
+        if len(files) == 0:
+            self.sendResponse("LST", "No data files stored at the server side.")
+            return
+
+        # Numeric fileIDs in number order, any others after them
+        files.sort(
+            key=lambda file: (
+                (0, int(file[0]), "") if file[0].isdecimal() else (1, 0, file[0])
+            )
+        )
+        lines = ["fileID; samples; bytes; created; modified"]
+        for fileID, (path, size, nSamples, created, modified) in files:
+            lines.append(
+                f"{fileID}; {nSamples}; {size}; "
+                f"{getFormattedDatetime(datetime.fromtimestamp(created))}; "
+                f"{getFormattedDatetime(datetime.fromtimestamp(modified))}"
+            )
+        self.sendResponse("LST", "\n".join(lines))
+
+    # Given a list of commands runs each in order and replies with all their replies
+    # Commands are text messages, or binary requests in binary mode
+    # Text reply has the number of replies, then each reply preceded by its length
+    def batchCommands(self, commands):
+        print(f"Edge device {self.username} issued BAT command of {len(commands)}")
+        self.batchReplies = []
+        for command in commands:
+            if self.binaryMode:
+                commandName, requestId, fields, body = decodeBinaryRequest(command)
+            else:
+                commandName = command[0:3]
+
+            if commandName in unbatchableCommands:
+                self.sendError(f"{commandName} cannot be run in a batch")
+            elif self.binaryMode:
+                self.runBinaryCommand(commandName, fields, body)
+            else:
+                self.runCommand(command)
+        batchReplies = self.batchReplies
+        self.batchReplies = None
+
+        if self.binaryMode:
+            self.sendBinaryReply("BAT", 1, batchReplies)
+            return
+
+        message = f"RC1;BAT resp: \n{len(batchReplies)}"
+        for reply in batchReplies:
+            message += f"\n{len(reply)}\n{reply}"
         self.sendMessage(message)
 
     # Creates a new file counting from 1 to specified amount each on new line
-    # File of format: USERNAME-FILEID.txt
+    # File of format: DATA_DIRECTORY/USERNAME/FILEID.txt
     def edgeDataGeneration(self, fileID, dataAmount):
-        message = "RC1;EDG resp: "
 
         try:
             # Check only integers supplied
             int(fileID)
             dataAmountInt = int(dataAmount)
 
-            dateFile = open(f"{self.username}-{fileID}.txt", "w")
-            fileOutput = ""
+            # File contents change, drop any cached aggregate until written
+            aggregateCache.invalidate((self.username, fileID))
 
             # Data generated always from 1 to specified amount
-            for i in range(1, dataAmountInt + 1):
-                fileOutput += f"{i}\n"
+            dataStore.write(
+                self.username,
+                fileID,
+                lambda path: writeSequenceFile(path, dataAmountInt),
+                max(dataAmountInt, 0),
+            )
 
-            # Write to file removing trailing new line
-            dateFile.write(fileOutput[:-1])
-            dateFile.close()
+            # Aggregate of 1..dataAmount is known without reading the file back
+            if dataAmountInt > 0:
+                aggregateCache.put(
+                    (self.username, fileID),
+                    (
+                        dataAmountInt,
+                        dataAmountInt * (dataAmountInt + 1) // 2,
+                        1,
+                        dataAmountInt,
+                    ),
+                )
+            else:
+                aggregateCache.put((self.username, fileID), emptyAggregate)
 
-            message += "\nData generation done."
+            message = "Data generation done."
         except:
             # Error message for when non-integers supplied
-            message += "\nThe fileID or dataAmount are not integers, you need to specify the parameter as integers."
+            message = "The fileID or dataAmount are not integers, you need to specify the parameter as integers."
 
-        self.sendMessage(message)
+        self.sendResponse("EDG", message)
 
     # Deletes requested file and logs operation if exists, else returns an error
     def deleteDataFile(self, fileID):
-        message = "RC1;DTE resp: "
-        requestedFileName = f"{self.username}-{fileID}.txt"
+        removedEntry = dataStore.remove(self.username, fileID)
         # Return error if file does not exist on server side
-        if not os.path.exists(requestedFileName):
-            message += "\nSpecified file does not exist at the server side."
+        if removedEntry is None:
+            message = "Specified file does not exist at the server side."
         else:
-            # Calculate data amount of requested file
-            requestedFile = open(requestedFileName, "r")
-            dataAmount = len(requestedFile.readlines())
-            requestedFile.close()
-
-            os.remove(requestedFileName)
+            # Data amount of the file is kept in the catalog
+            dataAmount = removedEntry[2]
+            aggregateCache.invalidate((self.username, fileID))
 
             # Append to deletion log
-            deletionLogFile = open(deletionLogFileName, "a")
             timestamp = getFormattedDatetime(datetime.now())
-            deletionLogFile.write(
-                f"{self.username}; {timestamp}; {fileID}; {dataAmount}\n"
+            logWriter.append(
+                deletionLogFileName,
+                f"{self.username}; {timestamp}; {fileID}; {dataAmount}\n",
             )
-            deletionLogFile.close()
 
-            message += f"\nFile with ID of {fileID} has been successfully removed from the central server."
+            message = f"File with ID of {fileID} has been successfully removed from the central server."
 
-        self.sendMessage(message)
+        self.sendResponse("DTE", message)
 
     # Given a fileID and a computationOperation executes requested operation on the file if valid
     def serverComputationService(self, fileID, compOp):
-        message = "RC1;SCS resp: "
-        requestedFileName = f"{self.username}-{fileID}.txt"
+        # Result sent as a number in binary mode
+        value = None
+        fileEntry = dataStore.lookup(self.username, fileID)
 
         # Allows case insensitive argument parsing
         upperCompOp = compOp.upper()
 
-        if not os.path.exists(requestedFileName):
-            message += "\nSpecified file does not exist at the server side."
+        if fileEntry is None:
+            message = "Specified file does not exist at the server side."
         else:
             try:
                 # Check only integer supplied for fileID
                 int(fileID)
-
-                # Check valid operation requested
-                if upperCompOp not in ["SUM", "AVERAGE", "MAX", "MIN"]:
-                    message += "\nThe computationOperation must be one of [SUM, AVERAGE, MAX, MIN]."
+                validFileID = True
+            except ValueError:
+                # Error message for when non-integer fileID supplied
+                message = "The fileID should be an integer."
+                validFileID = False
+
+            # Check valid operation requested
+            if validFileID and upperCompOp not in ["SUM", "AVERAGE", "MAX", "MIN"]:
+                message = (
+                    "The computationOperation must be one of [SUM, AVERAGE, MAX, MIN]."
+                )
+            elif validFileID:
+                # The file is only read if its aggregate is not cached
+                aggregate = aggregateCache.get((self.username, fileID))
+                if aggregate is None:
+                    aggregate = computeFileAggregate(fileEntry[0])
+                    aggregateCache.put((self.username, fileID), aggregate)
+                count, total, minimum, maximum = aggregate
+
+                # Execute computation
+                if count == 0:
+                    # Return Null if no numbers in file
+                    message = "Null"
                 else:
-                    requestedFile = open(requestedFileName, "r")
-                    requestedFileLines = requestedFile.readlines()
-                    requestedFile.close()
-
-                    fileNums = []
-
-                    for line in requestedFileLines:
-                        try:
-                            fileNums.append(int(line.strip()))
-                        except:
-                            # Skip line if not integer
-                            continue
-
-                    # Execute computation
-                    if len(fileNums) == 0:
-                        # Return Null if no numbers in file
-                        message += "\nNull"
-                    elif upperCompOp == "SUM":
-                        message += f"\n{sum(fileNums)}"
+                    if upperCompOp == "SUM":
+                        value = total
                     elif upperCompOp == "AVERAGE":
-                        message += f"\n{sum(fileNums)/len(fileNums)}"
+                        value = total / count
                     elif upperCompOp == "MAX":
-                        message += f"\n{max(fileNums)}"
+                        value = maximum
                     elif upperCompOp == "MIN":
-                        message += f"\n{min(fileNums)}"
+                        value = minimum
+                    message = f"{value}"
 
-            except:
-                # Error message for when non-integer fileID supplied
-                message += "\nThe fileID should be an integer."
-
-        self.sendMessage(message)
+        self.sendResponse("SCS", message, value)
 
-    # Given a fileID and fileData creates that file, and logs action
+    # Given a fileID and fileData bytes creates that file, and logs action
+    # fileData is decompressed first if the session uses compression
     def uploadEdgeData(self, fileID, fileData):
-        messageToSend = "RC1;UED resp: "
-        receivedFileName = f"{self.username}-{fileID}.txt"
-
-        # Output file onto server
-        receivedFile = open(receivedFileName, "w+")
-        receivedFile.write(fileData)
+        if self.compression is not None:
+            try:
+                fileData = decompressBody(self.compression, fileData)
+            except ProtocolError:
+                self.sendResponse("UED", "The uploaded data could not be decompressed.")
+                return
+
+        # Output file onto server, aggregate recomputed on next SCS
+        aggregateCache.invalidate((self.username, fileID))
+        if not dataStore.writeData(self.username, fileID, fileData):
+            self.sendResponse(
+                "UED", "The fileID cannot contain a path, spaces or non-decimal digits."
+            )
+            return
 
         # Add to upload log
-        uploadLogFile = open(uploadLogFileName, "a")
         timestamp = getFormattedDatetime(datetime.now())
-        dataAmount = len(receivedFile.readlines())
-        uploadLogFile.write(f"{self.username}; {timestamp}; {fileID}; {dataAmount}\n")
-
-        uploadLogFile.close()
-        receivedFile.close()
+        dataAmount = dataStore.lookup(self.username, fileID)[2]
+        logWriter.append(
+            uploadLogFileName, f"{self.username}; {timestamp}; {fileID}; {dataAmount}\n"
+        )
 
         # Send success response back to client
-        messageToSend += f"\nFile with ID {fileID} successfully received by server."
-        self.sendMessage(messageToSend)
+        messageToSend = f"File with ID {fileID} successfully received by server."
+        self.sendResponse("UED", messageToSend)
+
 
+"""
+    Threaded server mode. One thread is created for each connection received.
+"""
+
+
+class ClientThread(ClientSession, Thread):
+    def __init__(self, clientAddress, clientSocket):
+        Thread.__init__(self)
+        ClientSession.__init__(self, clientAddress)
+        self.clientSocket = clientSocket
+        self.frameReader = FrameReader(clientSocket)
+        # Pushes from other threads must not interleave with this thread's replies
+        self.sendLock = Lock()
+
+    def run(self):
+        try:
+            self.startLogin()
+            while self.clientAlive:
+                # Receive message from the client
+                data = self.frameReader.recvMessage()
+                if data is None:
+                    break
+                self.processMessage(data)
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            # Any other error still removes the device so the user can log in again
+            self.endSession()
+            self.clientSocket.close()
+
+    def sendBytes(self, data):
+        metrics.recordSent(len(data) + headerSize)
+        self.sendLock.acquire()
+        try:
+            sendFrame(self.clientSocket, data)
+        finally:
+            self.sendLock.release()
+
+
+def runThreadedServer():
+    while True:
+        serverSocket.listen()
+        clientSockt, clientAddress = serverSocket.accept()
+        clientThread = ClientThread(clientAddress, clientSockt)
+        clientThread.start()
+
+
+"""
+    Asyncio server mode. Each connection is a coroutine on a single event loop.
+    Messages which touch files are handled in the default executor so they do
+    not stall the other connections.
+"""
+
+
+class AsyncClientSession(ClientSession):
+    def __init__(self, reader, writer):
+        ClientSession.__init__(self, writer.get_extra_info("peername"))
+        self.reader = reader
+        self.writer = writer
+        self.loop = asyncio.get_running_loop()
+        self.loopThreadId = get_ident()
+        # Device events waiting for the SUB reply, None once it has been sent
+        self.heldPushes = None
+
+    async def run(self):
+        try:
+            self.startLogin()
+            while self.clientAlive:
+                # Receive message from the client
+                data = await recvFrameAsync(self.reader)
+                if data is None:
+                    break
+
+                if self.isBlockingMessage(data):
+                    await self.loop.run_in_executor(None, self.processMessage, data)
+                else:
+                    self.processMessage(data)
+                await self.writer.drain()
+        except (ConnectionError, ProtocolError):
+            pass
+        finally:
+            # Any other error still removes the device so the user can log in again
+            self.endSession()
+            self.writer.close()
+
+    # Pushes are written by the event loop instead of a thread. Every event goes
+    # through call_soon_threadsafe, even from the loop, so they stay in order
+    def holdPushes(self):
+        self.heldPushes = []
+
+    # Held events are written after any reply already handed to the loop
+    def releasePushes(self):
+        self.loop.call_soon_threadsafe(self.deliverHeldPushes)
+
+    def queuePush(self, event):
+        self.loop.call_soon_threadsafe(self.deliverPush, event)
+
+    def stopPushes(self):
+        pass
+
+    # Writes the events queued before releasePushes
+    def deliverHeldPushes(self):
+        heldPushes = self.heldPushes
+        self.heldPushes = None
+        for event in heldPushes:
+            self.deliverPush(event)
+
+    # Given a device event writes it unless the client has stopped reading
+    def deliverPush(self, event):
+        if self.heldPushes is not None:
+            self.heldPushes.append(event)
+            return
+        if self.writer.transport.get_write_buffer_size() > maxPushBufferBytes:
+            print(f"[{self.clientAddress}:send] dropped !{event}, client not reading")
+            return
+        self.sendPush(event)
+
+    # Writes directly when on the event loop, otherwise hands the write to the loop
+    def sendBytes(self, data):
+        metrics.recordSent(len(data) + headerSize)
+        frame = [headerStruct.pack(len(data)), data]
+        if get_ident() == self.loopThreadId:
+            self.writer.writelines(frame)
+        else:
+            self.loop.call_soon_threadsafe(self.writer.writelines, frame)
+
+
+async def handleAsyncConnection(reader, writer):
+    session = AsyncClientSession(reader, writer)
+    await session.run()
+
+
+async def runAsyncServer():
+    server = await asyncio.start_server(handleAsyncConnection, sock=serverSocket)
+    async with server:
+        await server.serve_forever()
+
+
+# Load credentials index before accepting connections
+refreshCredentials()
+
+# Index stored data files, moving in any from older versions if asked to
+dataStore = DataStore(dataDirectoryName, dataFsync == "on")
+dataStore.load(migrateLegacy == "on")
+
+# Start log writer, writing any records still waiting on shutdown
+logWriter = LogWriter(logFsync == "on")
+logWriter.start()
+atexit.register(logWriter.flush)
+
+# Start edge device log writer, compacting a final time on shutdown
+edgeDeviceLog = EdgeDeviceLogWriter()
+edgeDeviceLog.start()
+atexit.register(edgeDeviceLog.compact)
+
+
+# Writes waiting log records and compacts the device log, then exits at once
+# A normal exit would wait for every connected client's thread to finish
+def shutdown():
+    logWriter.flush()
+    edgeDeviceLog.compact()
+    os._exit(0)
+
+
+# Shuts down from another thread, as the interrupted thread may hold a lock
+# which the final writes need
+signal.signal(
+    signal.SIGTERM,
+    lambda signalNumber, frame: Thread(target=shutdown, daemon=True).start(),
+)
+
+# Start writing statistics to a file if requested
+if statsFileName is not None:
+    StatsFileWriter().start()
 
 print("\n===== Server is running =====")
+print(f"===== Mode: {serverMode} =====")
 print("===== Waiting for connection request from clients...=====")
 
-
-while True:
-    serverSocket.listen()
-    clientSockt, clientAddress = serverSocket.accept()
-    clientThread = ClientThread(clientAddress, clientSockt)
-    clientThread.start()
+if serverMode == "asyncio":
+    asyncio.run(runAsyncServer())
+else:
+    runThreadedServer()
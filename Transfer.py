@@ -0,0 +1,798 @@
+"""
+    Reliable UVF file transfer over UDP, used between clients.
+
+    The sender opens a transfer with a START packet, then sends the file as
+    numbered DATA chunks inside a sliding window. The receiver acknowledges
+    with the count of chunks received in order plus a bitmap of chunks received
+    beyond that (selective ACK), and writes each chunk at its own offset so
+    chunks may arrive in any order. Lost chunks are resent on a gap in the
+    selective ACKs or on timeout, and the window grows and shrinks with loss
+    (additive increase, multiplicative decrease) with sends paced across the
+    round trip time.
+
+    Chunks may be compressed. The START packet then names the method, and each
+    chunk that shrinks is sent as a COMPRESSED DATA packet, the rest as DATA.
+"""
+from socket import *
+import os, math, mmap, time, random, select, struct, zlib, lzma, heapq
+from Protocol import compressionMethods, defaultCompressionLevel
+
+# Every packet starts with magic, packet type and transfer ID
+packetPrefix = struct.Struct("!2sBI")
+packetMagic = b"UV"
+
+packetStart = 1
+packetStartAck = 2
+packetData = 3
+packetAck = 4
+packetCompressedData = 5
+
+# START: file size, chunk size, number of chunks, then "fileName\nsenderName"
+# followed by "\nmethod" if chunks may be compressed
+startFields = struct.Struct("!QHI")
+# DATA and COMPRESSED DATA: chunk sequence number, then the chunk
+dataFields = struct.Struct("!I")
+# ACK: chunks received in order, bitmap length, then bitmap of later chunks
+ackFields = struct.Struct("!IH")
+
+dataHeaderSize = packetPrefix.size + dataFields.size
+
+defaultChunkSize = 4096
+
+# Window limits in chunks
+initialWindow = 16
+maxWindow = 2048
+
+# Most chunks beyond the in-order point that one ACK can report, a whole window
+# so chunks sent behind a lost one are still acknowledged
+maxSackChunks = maxWindow
+
+# Pacing gaps shorter than this in seconds are sent as a burst instead, select
+# cannot wait for so short a time
+minPacingInterval = 0.001
+
+# Retransmission timeout bounds in seconds
+minRetransmitTimeout = 0.05
+maxRetransmitTimeout = 2.0
+
+# Seconds without any reply before a transfer is abandoned
+transferTimeout = 10.0
+
+# START packets sent before giving up on a peer
+maxStartAttempts = 5
+
+# Receiver acknowledges every this many chunks, or sooner on a gap
+ackEvery = 8
+# Seconds a receiver holds an acknowledgement before sending it anyway
+ackDelay = 0.005
+
+# Most transfers a receiver accepts at once
+maxIncomingTransfers = 64
+
+# Largest file a receiver accepts, and most bytes it reserves for the files of
+# all its transfers at once. START packets are not authenticated so these bound
+# what any sender can make a receiver allocate
+maxIncomingFileSize = 1 << 30
+maxIncomingBytes = 2 << 30
+
+# Most chunks an incoming file may have, bounding the receiver's per-chunk state
+maxIncomingChunks = maxIncomingFileSize // defaultChunkSize
+
+# LZMA dictionary for one chunk, no chunk is larger than a datagram
+chunkDictionarySize = 1 << 16
+
+# After this many chunks in a row do not shrink, only every
+# incompressibleRetry-th chunk is tried so media files cost little CPU
+incompressibleLimit = 16
+incompressibleRetry = 64
+
+
+class TransferError(Exception):
+    pass
+
+
+# Given a packet type, transfer ID and body returns the packet
+def encodePacket(packetType, transferId, body=b""):
+    return packetPrefix.pack(packetMagic, packetType, transferId) + body
+
+
+# Given a packet returns (packetType, transferId), or None if not a UVF packet
+def decodePacketPrefix(packet):
+    if len(packet) < packetPrefix.size:
+        return None
+    magic, packetType, transferId = packetPrefix.unpack_from(packet)
+    if magic != packetMagic:
+        return None
+    return packetType, transferId
+
+
+# Given a level 0-9 returns the LZMA filters for compressing one chunk
+def lzmaChunkFilters(level=defaultCompressionLevel):
+    return [
+        {"id": lzma.FILTER_LZMA2, "preset": level, "dict_size": chunkDictionarySize}
+    ]
+
+
+# Given a compression method, chunk and level returns the compressed chunk
+# Chunks carry no container headers, the datagram already frames them
+def compressChunk(method, chunk, level):
+    if method == "zlib":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        return compressor.compress(chunk) + compressor.flush()
+    return lzma.compress(chunk, format=lzma.FORMAT_RAW, filters=lzmaChunkFilters(level))
+
+
+# Given a compression method, compressed chunk and its original length returns
+# the chunk, or None if it is damaged or not that length
+def decompressChunk(method, data, length):
+    if method == "zlib":
+        decompressor = zlib.decompressobj(-15)
+    else:
+        decompressor = lzma.LZMADecompressor(
+            format=lzma.FORMAT_RAW, filters=lzmaChunkFilters()
+        )
+    try:
+        # One byte spare shows a chunk which is too long
+        chunk = decompressor.decompress(data, length + 1)
+    except (zlib.error, lzma.LZMAError):
+        return None
+    if not decompressor.eof or len(chunk) != length:
+        return None
+    return chunk
+
+
+"""
+    Sender
+"""
+
+
+# Sends one file to a peer and tracks which chunks it has acknowledged
+# Chunks are compressed with compression ("zlib" or "lzma") if given
+class TransferSender:
+    def __init__(
+        self,
+        filePath,
+        peerAddress,
+        senderName,
+        chunkSize=defaultChunkSize,
+        compression=None,
+        compressionLevel=defaultCompressionLevel,
+    ):
+        self.filePath = filePath
+        self.peerAddress = peerAddress
+        self.senderName = senderName
+        self.chunkSize = chunkSize
+        self.compression = compression
+        self.compressionLevel = compressionLevel
+        self.incompressibleRun = 0
+        self.fileSize = os.path.getsize(filePath)
+        self.nChunks = math.ceil(self.fileSize / chunkSize)
+        self.transferId = random.getrandbits(32)
+
+        # Own socket so acknowledgements do not reach the listener thread
+        self.sock = socket(AF_INET, SOCK_DGRAM)
+
+        # Chunk state. inFlight maps sent but unacknowledged chunks to send time
+        self.acked = bytearray(self.nChunks)
+        self.nAcked = 0
+        self.ackedInOrder = 0
+        self.inFlight = {}
+        self.retransmitted = set()
+        # Heap of lost chunks waiting to be resent
+        self.retransmitQueue = []
+        self.nextSeq = 0
+
+        # Congestion control
+        self.window = float(initialWindow)
+        self.slowStartThreshold = float(maxWindow)
+        self.recoveryPoint = 0
+        self.smoothedRtt = None
+        self.rttVariance = 0.0
+        self.retransmitTimeout = 0.2
+        self.nextSendTime = 0.0
+
+        # Headers reused for every DATA packet, the chunk is sent from the file mapping
+        self.dataHeader = bytearray(encodePacket(packetData, self.transferId)) + bytes(
+            dataFields.size
+        )
+        self.compressedHeader = bytearray(
+            encodePacket(packetCompressedData, self.transferId)
+        ) + bytes(dataFields.size)
+        self.ackBuffer = bytearray(65536)
+
+        # Statistics
+        self.packetsSent = 0
+        self.packetsRetransmitted = 0
+        self.packetsCompressed = 0
+        self.chunkBytesSent = 0
+
+    # Given a progress callback sends the whole file
+    # progress is called with the number of acknowledged chunks as they increase
+    def run(self, progress=None):
+        byteFile = open(self.filePath, "rb")
+        fileMap = None
+        try:
+            # Chunks are sent as slices of the mapped file without copying
+            if self.fileSize > 0:
+                fileMap = mmap.mmap(byteFile.fileno(), 0, access=mmap.ACCESS_READ)
+                fileView = memoryview(fileMap)
+            else:
+                fileView = memoryview(b"")
+
+            self.openTransfer()
+            lastReply = time.monotonic()
+            lastReported = -1
+
+            while self.nAcked < self.nChunks:
+                now = time.monotonic()
+                self.sendAllowed(fileView, now)
+
+                # Wait for acknowledgements until the next send or timeout is due
+                readable, writable, errored = select.select(
+                    [self.sock], [], [], self.waitTime(now)
+                )
+                now = time.monotonic()
+                if readable:
+                    if self.receiveAcks(now):
+                        lastReply = now
+                elif now - lastReply > transferTimeout:
+                    raise TransferError("peer stopped responding")
+                self.checkTimeouts(now)
+
+                if progress is not None and self.nAcked != lastReported:
+                    lastReported = self.nAcked
+                    progress(self.nAcked, self.nChunks)
+        finally:
+            fileView.release()
+            if fileMap is not None:
+                fileMap.close()
+            byteFile.close()
+            self.sock.close()
+
+    # Sends START until the peer acknowledges it
+    def openTransfer(self):
+        names = f"{os.path.basename(self.filePath)}\n{self.senderName}"
+        if self.compression is not None:
+            names += f"\n{self.compression}"
+        names = names.encode()
+        startPacket = encodePacket(
+            packetStart,
+            self.transferId,
+            startFields.pack(self.fileSize, self.chunkSize, self.nChunks) + names,
+        )
+
+        for attempt in range(maxStartAttempts):
+            sentTime = time.monotonic()
+            self.sock.sendto(startPacket, self.peerAddress)
+            deadline = sentTime + 0.5 * (attempt + 1)
+            while True:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                readable, writable, errored = select.select(
+                    [self.sock], [], [], timeout
+                )
+                if not readable:
+                    break
+                n, address = self.sock.recvfrom_into(self.ackBuffer)
+                prefix = decodePacketPrefix(memoryview(self.ackBuffer)[:n])
+                if prefix == (packetStartAck, self.transferId):
+                    self.updateRtt(time.monotonic() - sentTime)
+                    return
+        raise TransferError("peer did not respond")
+
+    # Given a view of the file and time sends chunks while the window and pacing allow
+    def sendAllowed(self, fileView, now):
+        while (
+            len(self.inFlight) < int(self.window)
+            and now + minPacingInterval >= self.nextSendTime
+        ):
+            if len(self.retransmitQueue) > 0:
+                seq = heapq.heappop(self.retransmitQueue)
+                if self.acked[seq] or seq in self.inFlight:
+                    continue
+                self.retransmitted.add(seq)
+                self.packetsRetransmitted += 1
+            elif self.nextSeq < self.nChunks:
+                seq = self.nextSeq
+                self.nextSeq += 1
+            else:
+                return
+
+            start = seq * self.chunkSize
+            header, chunk = self.encodeChunk(
+                seq, fileView[start : start + self.chunkSize]
+            )
+            self.sendData(seq, header, chunk)
+            now = time.monotonic()
+            self.inFlight[seq] = now
+            self.packetsSent += 1
+            self.chunkBytesSent += len(chunk)
+
+            # Pace the window across one round trip
+            if self.smoothedRtt is not None:
+                interval = self.smoothedRtt / max(self.window, 1.0)
+                self.nextSendTime = max(self.nextSendTime, now) + interval
+
+    # Given a sequence number and view of the chunk returns the packet header and
+    # chunk to send, compressing the chunk when that makes it smaller
+    def encodeChunk(self, seq, chunk):
+        if self.compression is None:
+            return self.dataHeader, chunk
+        if (
+            self.incompressibleRun >= incompressibleLimit
+            and seq % incompressibleRetry != 0
+        ):
+            return self.dataHeader, chunk
+
+        compressed = compressChunk(self.compression, chunk, self.compressionLevel)
+        if len(compressed) >= len(chunk):
+            self.incompressibleRun += 1
+            return self.dataHeader, chunk
+        self.incompressibleRun = 0
+        self.packetsCompressed += 1
+        return self.compressedHeader, compressed
+
+    # Given a sequence number, packet header and chunk sends a DATA packet
+    if hasattr(socket, "sendmsg"):
+
+        def sendData(self, seq, header, chunk):
+            dataFields.pack_into(header, packetPrefix.size, seq)
+            self.sock.sendmsg([header, chunk], [], 0, self.peerAddress)
+
+    else:
+        # Platforms without sendmsg join the header and chunk into one buffer
+        def sendData(self, seq, header, chunk):
+            dataFields.pack_into(header, packetPrefix.size, seq)
+            self.sock.sendto(bytes(header) + chunk, self.peerAddress)
+
+    # Given the time returns how long to wait for acknowledgements
+    def waitTime(self, now):
+        waits = [self.retransmitTimeout]
+        if len(self.inFlight) > 0:
+            # Chunks are added to inFlight as they are sent so the first is oldest
+            oldestSend = next(iter(self.inFlight.values()))
+            waits.append(oldestSend + self.retransmitTimeout - now)
+        if len(self.inFlight) < int(self.window):
+            waits.append(self.nextSendTime - now)
+        return max(0.0, min(waits))
+
+    # Given the time reads every queued acknowledgement
+    # Returns True if any acknowledgement for this transfer arrived
+    def receiveAcks(self, now):
+        received = False
+        self.sock.setblocking(False)
+        try:
+            while True:
+                n, address = self.sock.recvfrom_into(self.ackBuffer)
+                packet = memoryview(self.ackBuffer)[:n]
+                prefix = decodePacketPrefix(packet)
+                if prefix != (packetAck, self.transferId):
+                    continue
+                if n < packetPrefix.size + ackFields.size:
+                    # Truncated, the next ACK reports the same chunks
+                    continue
+                received = True
+                ackedInOrder, bitmapLength = ackFields.unpack_from(
+                    packet, packetPrefix.size
+                )
+                bitmapStart = packetPrefix.size + ackFields.size
+                bitmap = int.from_bytes(
+                    packet[bitmapStart : bitmapStart + bitmapLength], "little"
+                )
+                self.processAck(ackedInOrder, bitmap, now)
+        except BlockingIOError:
+            pass
+        finally:
+            self.sock.setblocking(True)
+        return received
+
+    # Given the in-order count and selective ACK bitmap marks chunks acknowledged
+    def processAck(self, ackedInOrder, bitmap, now):
+        newlyAcked = []
+        for seq in range(self.ackedInOrder, min(ackedInOrder, self.nChunks)):
+            if not self.acked[seq]:
+                newlyAcked.append(seq)
+        self.ackedInOrder = max(self.ackedInOrder, ackedInOrder)
+
+        # Bit i set means chunk ackedInOrder + 1 + i was received
+        highestSacked = -1
+        while bitmap:
+            lowestBit = bitmap & -bitmap
+            seq = ackedInOrder + lowestBit.bit_length()
+            bitmap ^= lowestBit
+            highestSacked = seq
+            if seq < self.nChunks and not self.acked[seq]:
+                newlyAcked.append(seq)
+
+        rttSample = None
+        for seq in newlyAcked:
+            self.acked[seq] = 1
+            self.nAcked += 1
+            sentTime = self.inFlight.pop(seq, None)
+            # Only chunks sent once give a clean round trip sample
+            if sentTime is not None and seq not in self.retransmitted:
+                rttSample = now - sentTime
+
+            # Grow window, quickly until the slow start threshold then by one per window
+            if self.window < self.slowStartThreshold:
+                self.window += 1
+            else:
+                self.window += 1 / self.window
+        self.window = min(self.window, float(maxWindow))
+        if rttSample is not None:
+            self.updateRtt(rttSample)
+
+        # Chunks in flight well below a selectively acknowledged one are lost
+        if highestSacked >= 0:
+            lost = [seq for seq in self.inFlight if seq < highestSacked - 3]
+            if len(lost) > 0:
+                self.markLost(lost, False)
+
+    # Given the time resends chunks whose acknowledgement is overdue
+    def checkTimeouts(self, now):
+        expired = []
+        for seq, sentTime in self.inFlight.items():
+            if now - sentTime <= self.retransmitTimeout:
+                break
+            expired.append(seq)
+        if len(expired) > 0:
+            self.markLost(expired, True)
+            # Back off in case the path is congested
+            self.retransmitTimeout = min(
+                self.retransmitTimeout * 2, maxRetransmitTimeout
+            )
+
+    # Given lost chunks queues them to resend and shrinks the window
+    # The window shrinks once per window of data, not for every lost chunk
+    def markLost(self, lost, timedOut):
+        for seq in lost:
+            self.inFlight.pop(seq, None)
+        # Lowest chunks are resent first, they hold back the in-order point
+        for seq in lost:
+            heapq.heappush(self.retransmitQueue, seq)
+
+        if timedOut or min(lost) >= self.recoveryPoint:
+            self.slowStartThreshold = max(self.window / 2, 2.0)
+            self.window = 2.0 if timedOut else self.slowStartThreshold
+            self.recoveryPoint = self.nextSeq
+
+    # Given a round trip time sample updates the smoothed estimate and timeout
+    def updateRtt(self, sample):
+        if self.smoothedRtt is None:
+            self.smoothedRtt = sample
+            self.rttVariance = sample / 2
+        else:
+            self.rttVariance = 0.75 * self.rttVariance + 0.25 * abs(
+                self.smoothedRtt - sample
+            )
+            self.smoothedRtt = 0.875 * self.smoothedRtt + 0.125 * sample
+        self.retransmitTimeout = min(
+            max(self.smoothedRtt + 4 * self.rttVariance, minRetransmitTimeout),
+            maxRetransmitTimeout,
+        )
+
+
+# Given a file path, peer address, sender name and optional progress callback
+# sends the file, compressing chunks with compression if given
+# Raises TransferError if the peer does not receive it
+def sendFile(
+    filePath,
+    peerAddress,
+    senderName,
+    progress=None,
+    chunkSize=None,
+    compression=None,
+    compressionLevel=defaultCompressionLevel,
+):
+    sender = TransferSender(
+        filePath,
+        peerAddress,
+        senderName,
+        chunkSize or defaultChunkSize,
+        compression,
+        compressionLevel,
+    )
+    sender.run(progress)
+    return sender
+
+
+"""
+    Receiver
+"""
+
+
+# State of one incoming file
+class IncomingTransfer:
+    def __init__(
+        self,
+        transferId,
+        senderAddress,
+        fileName,
+        senderName,
+        fileSize,
+        chunkSize,
+        nChunks,
+        outputDirectory,
+        compression=None,
+    ):
+        self.transferId = transferId
+        self.senderAddress = senderAddress
+        self.fileName = fileName
+        self.senderName = senderName
+        self.fileSize = fileSize
+        self.chunkSize = chunkSize
+        self.nChunks = nChunks
+        self.compression = compression
+
+        # Written under a temporary name until every chunk has arrived
+        self.filePath = os.path.join(outputDirectory, fileName)
+        # Transfer ID in the name keeps simultaneous transfers of one file apart
+        self.partPath = f"{self.filePath}.{transferId:08x}.part"
+        self.outFile = open(self.partPath, "w+b")
+        # Chunks are written straight into a mapping of the preallocated file
+        self.fileMap = None
+        try:
+            self.outFile.truncate(fileSize)
+            if fileSize > 0:
+                self.fileMap = mmap.mmap(self.outFile.fileno(), fileSize)
+        except (OSError, ValueError, OverflowError):
+            # Too large for the disk or address space
+            self.outFile.close()
+            os.remove(self.partPath)
+            raise OSError(f"cannot allocate {fileSize} bytes for {fileName}")
+
+        self.received = bytearray(nChunks)
+        self.nReceived = 0
+        self.receivedInOrder = 0
+        self.highestReceived = -1
+        self.unacked = 0
+        self.ackDue = None
+        self.lastActivity = time.monotonic()
+        self.complete = nChunks == 0
+
+    # Given a sequence number and compressed chunk returns the chunk, or None if
+    # it cannot be decompressed to the length expected at that position
+    def decompressChunk(self, seq, data):
+        if self.compression is None or seq >= self.nChunks:
+            return None
+        start = seq * self.chunkSize
+        return decompressChunk(
+            self.compression, data, min(start + self.chunkSize, self.fileSize) - start
+        )
+
+    # Given a sequence number and chunk stores it. Returns True if it was new
+    def storeChunk(self, seq, chunk):
+        if seq >= self.nChunks or self.received[seq]:
+            return False
+        start = seq * self.chunkSize
+        end = min(start + self.chunkSize, self.fileSize)
+        if len(chunk) != end - start:
+            return False
+        self.fileMap[start:end] = chunk
+        self.received[seq] = 1
+        self.nReceived += 1
+        self.highestReceived = max(self.highestReceived, seq)
+        while (
+            self.receivedInOrder < self.nChunks and self.received[self.receivedInOrder]
+        ):
+            self.receivedInOrder += 1
+        if self.nReceived == self.nChunks:
+            self.complete = True
+        return True
+
+    # Returns the ACK packet describing the chunks received so far
+    def ackPacket(self):
+        bitmap = 0
+        end = min(self.highestReceived, self.receivedInOrder + maxSackChunks)
+        for seq in range(self.receivedInOrder + 1, end + 1):
+            if self.received[seq]:
+                bitmap |= 1 << (seq - self.receivedInOrder - 1)
+        bitmapBytes = bitmap.to_bytes((bitmap.bit_length() + 7) // 8, "little")
+        return encodePacket(
+            packetAck,
+            self.transferId,
+            ackFields.pack(self.receivedInOrder, len(bitmapBytes)) + bitmapBytes,
+        )
+
+    # Closes the mapping and file
+    def closeFile(self):
+        if self.fileMap is not None:
+            self.fileMap.close()
+        self.outFile.close()
+
+    # Moves the completed file into place
+    def finish(self):
+        self.closeFile()
+        os.replace(self.partPath, self.filePath)
+
+    # Discards an unfinished file
+    def abandon(self):
+        self.closeFile()
+        if os.path.exists(self.partPath):
+            os.remove(self.partPath)
+
+
+# Receives UVF transfers arriving on a UDP socket
+# Any number of transfers can arrive at once, each identified by the sender
+# address and transfer ID with its own reassembly state
+# The owner passes every datagram to handlePacket and calls tick regularly so
+# delayed acknowledgements are sent and stalled transfers abandoned
+class TransferReceiver:
+    def __init__(self, sock, outputDirectory=".", onComplete=None, onError=None):
+        self.sock = sock
+        self.outputDirectory = outputDirectory
+        self.onComplete = onComplete
+        self.onError = onError
+        # Active transfers by (senderAddress, transferId)
+        self.transfers = {}
+        # Finished transfers by key with the time they can be forgotten, kept so
+        # a lost final ACK can be repeated
+        self.finished = {}
+
+    # Given a datagram and sender address handles it. The datagram may be a view
+    # of a reused receive buffer, nothing from it is kept after returning
+    # Returns False if the datagram is not a valid UVF packet, and drops it
+    def handlePacket(self, packet, address):
+        prefix = decodePacketPrefix(packet)
+        if prefix is None:
+            return False
+        packetType, transferId = prefix
+        key = (address, transferId)
+
+        if packetType == packetStart:
+            return self.handleStart(packet, address, key)
+
+        if packetType != packetData and packetType != packetCompressedData:
+            return True
+        if len(packet) < dataHeaderSize:
+            return False
+        transfer = self.transfers.get(key)
+        if transfer is None:
+            finished = self.finished.get(key)
+            if finished is not None:
+                self.sock.sendto(finished[0].ackPacket(), address)
+            return True
+
+        (seq,) = dataFields.unpack_from(packet, packetPrefix.size)
+        inOrder = seq == transfer.receivedInOrder
+        chunk = packet[dataHeaderSize:]
+        if packetType == packetCompressedData:
+            # A damaged chunk is dropped and the sender resends it
+            chunk = transfer.decompressChunk(seq, chunk)
+        if chunk is not None:
+            transfer.storeChunk(seq, chunk)
+        transfer.lastActivity = time.monotonic()
+        transfer.unacked += 1
+
+        # Acknowledge at once on a gap or completion, otherwise batch acknowledgements
+        if not inOrder or transfer.complete or transfer.unacked >= ackEvery:
+            self.sendAck(transfer)
+        elif transfer.ackDue is None:
+            transfer.ackDue = transfer.lastActivity + ackDelay
+
+        if transfer.complete:
+            self.completeTransfer(key, transfer)
+        return True
+
+    # Given a START packet, its sender and transfer key opens the transfer
+    # Returns False if the packet is malformed, clashes with an active transfer or
+    # the file is too large or cannot be created
+    # Nothing is acknowledged then, so the sender reports the peer did not respond
+    def handleStart(self, packet, address, key):
+        transferId = key[1]
+        if key in self.finished:
+            # START resent because our reply was lost
+            self.sock.sendto(encodePacket(packetStartAck, transferId), address)
+            return True
+
+        if len(packet) < packetPrefix.size + startFields.size:
+            return False
+        fileSize, chunkSize, nChunks = startFields.unpack_from(
+            packet, packetPrefix.size
+        )
+
+        active = self.transfers.get(key)
+        if active is not None:
+            # START resent because our reply was lost, it must describe the same file
+            if (fileSize, chunkSize, nChunks) != (
+                active.fileSize,
+                active.chunkSize,
+                active.nChunks,
+            ):
+                return False
+            self.sock.sendto(encodePacket(packetStartAck, transferId), address)
+            return True
+        # A transfer ID is only ever used by one sender at a time
+        for activeAddress, activeId in self.transfers:
+            if activeId == transferId:
+                return False
+
+        if chunkSize == 0 or nChunks != -(-fileSize // chunkSize):
+            return False
+        if fileSize > maxIncomingFileSize or nChunks > maxIncomingChunks:
+            return False
+        reservedBytes = sum(transfer.fileSize for transfer in self.transfers.values())
+        if (
+            len(self.transfers) >= maxIncomingTransfers
+            or reservedBytes + fileSize > maxIncomingBytes
+        ):
+            # Too busy, the sender will retry
+            return True
+
+        try:
+            names = bytes(packet[packetPrefix.size + startFields.size :]).decode()
+        except UnicodeDecodeError:
+            return False
+        names = names.split("\n")
+        if len(names) < 2 or len(names) > 3:
+            return False
+        # Never write outside the output directory
+        fileName, senderName = os.path.basename(names[0]), names[1]
+        if fileName in ["", ".", ".."]:
+            return False
+        compression = names[2] if len(names) > 2 else None
+        if compression is not None and compression not in compressionMethods:
+            return False
+
+        try:
+            transfer = IncomingTransfer(
+                transferId,
+                address,
+                fileName,
+                senderName,
+                fileSize,
+                chunkSize,
+                nChunks,
+                self.outputDirectory,
+                compression,
+            )
+        except OSError:
+            return False
+        self.transfers[key] = transfer
+        self.sock.sendto(encodePacket(packetStartAck, transferId), address)
+        if transfer.complete:
+            self.completeTransfer(key, transfer)
+        return True
+
+    # Given a transfer sends its acknowledgement
+    def sendAck(self, transfer):
+        self.sock.sendto(transfer.ackPacket(), transfer.senderAddress)
+        transfer.unacked = 0
+        transfer.ackDue = None
+
+    # Given a transfer key and transfer with every chunk received finishes the file
+    def completeTransfer(self, key, transfer):
+        transfer.finish()
+        del self.transfers[key]
+        self.finished[key] = (transfer, time.monotonic() + transferTimeout)
+        if self.onComplete is not None:
+            self.onComplete(transfer)
+
+    # Sends due acknowledgements and abandons stalled transfers
+    # Returns the time the next call is needed by, or None if nothing is pending
+    def tick(self):
+        now = time.monotonic()
+        nextTick = None
+
+        for key, transfer in list(self.transfers.items()):
+            if transfer.ackDue is not None and now >= transfer.ackDue:
+                self.sendAck(transfer)
+            if now - transfer.lastActivity > transferTimeout:
+                transfer.abandon()
+                del self.transfers[key]
+                if self.onError is not None:
+                    self.onError(transfer, "sender stopped responding")
+                continue
+            due = transfer.ackDue
+            if due is None:
+                due = transfer.lastActivity + transferTimeout
+            if nextTick is None or due < nextTick:
+                nextTick = due
+
+        for key, (transfer, expiry) in list(self.finished.items()):
+            if now >= expiry:
+                del self.finished[key]
+            elif nextTick is None or expiry < nextTick:
+                nextTick = expiry
+        return nextTick
@@ -0,0 +1,323 @@
+"""
+    Usage: python3 TransferBenchmark.py [--option=value ...]
+
+    Benchmark for UVF peer transfers over loopback. Sends synthetic files with
+    the same transfer code the client uses to a receiver in another process,
+    optionally through a shim process which drops and reorders datagrams, and
+    reports throughput, CPU time per MB, retransmissions, bytes on the wire and
+    whether the received file's checksum matches.
+
+    Options:
+        --sizes=SIZE,...    file sizes with optional K, M or G suffix
+                            (default 64K,1M,16M)
+        --loss=FRACTION     chance the shim drops each datagram, both ways (default 0)
+        --reorder=FRACTION  chance the shim holds a datagram back behind the next
+                            one (default 0)
+        --chunk-size=N      bytes of file per datagram (default 4096)
+        --repeat=N          transfers of each size (default 1)
+        --content=KIND      random bytes, or samples like EDG files (default random)
+        --compression=NAME  none, zlib or lzma chunk compression (default none)
+        --compression-level=N  0-9 (default 6)
+
+    With no loss or reordering the shim is skipped and the sender talks to the
+    receiver directly.
+"""
+from socket import *
+import sys, os, re, time, random, select, hashlib, tempfile, shutil
+import multiprocessing
+from Transfer import TransferReceiver, sendFile, defaultChunkSize
+from Protocol import compressionMethods, defaultCompressionLevel
+
+
+# Optional settings given as --name=value
+benchOptions = {}
+for arg in sys.argv[1:]:
+    if not re.match("^--[a-z-]+=.+$", arg):
+        print(f"\nError usage: unrecognised option {arg}, expected --name=value")
+        exit(0)
+    optionName, optionValue = arg[2:].split("=", 1)
+    benchOptions[optionName] = optionValue
+
+
+# Given a size such as 64K, 1M or 2G returns the number of bytes
+def parseSize(text):
+    multipliers = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text[-1].upper() in multipliers:
+        return int(float(text[:-1]) * multipliers[text[-1].upper()])
+    return int(text)
+
+
+try:
+    fileSizes = [
+        parseSize(size) for size in benchOptions.get("sizes", "64K,1M,16M").split(",")
+    ]
+    lossRate = float(benchOptions.get("loss", 0))
+    reorderRate = float(benchOptions.get("reorder", 0))
+    chunkSize = int(benchOptions.get("chunk-size", defaultChunkSize))
+    nRepeats = int(benchOptions.get("repeat", 1))
+    compressionLevel = int(
+        benchOptions.get("compression-level", defaultCompressionLevel)
+    )
+except ValueError:
+    print("\nError usage: option values must be numbers")
+    exit(0)
+if chunkSize < 1 or chunkSize > 65000:
+    print("\nError usage: --chunk-size must be between 1 and 65000")
+    exit(0)
+fileContent = benchOptions.get("content", "random")
+if fileContent not in ["random", "samples"]:
+    print("\nError usage: --content must be one of [random, samples]")
+    exit(0)
+compression = benchOptions.get("compression", "none")
+if compression not in ["none"] + compressionMethods:
+    print(
+        f"\nError usage: --compression must be one of {['none'] + compressionMethods}"
+    )
+    exit(0)
+if compressionLevel < 0 or compressionLevel > 9:
+    print("\nError usage: --compression-level must be between 0 and 9")
+    exit(0)
+
+"""
+    Receiver and shim processes
+"""
+
+
+# Runs a UVF receiver until told to stop
+# Before each transfer the parent sends "mark" and gets the CPU time back, and
+# after each transfer it gets (fileName, CPU time)
+def runReceiver(outputDirectory, control):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 << 20)
+    sock.setblocking(False)
+    buffer = bytearray(65536)
+    view = memoryview(buffer)
+
+    receiver = TransferReceiver(
+        sock,
+        outputDirectory,
+        onComplete=lambda transfer: control.send(
+            (transfer.fileName, time.process_time())
+        ),
+        onError=lambda transfer, reason: control.send((None, reason)),
+    )
+    control.send(sock.getsockname())
+
+    while True:
+        nextTick = receiver.tick()
+        timeout = None if nextTick is None else max(0, nextTick - time.monotonic())
+        readable, writable, errored = select.select([sock, control], [], [], timeout)
+
+        if control in readable:
+            request = control.recv()
+            if request == "stop":
+                break
+            control.send(time.process_time())
+
+        if sock in readable:
+            while True:
+                try:
+                    n, address = sock.recvfrom_into(buffer)
+                except (BlockingIOError, InterruptedError):
+                    break
+                receiver.handlePacket(view[:n], address)
+    sock.close()
+
+
+# Relays datagrams between a sender and the receiver, dropping and reordering
+# some. Reports (dropped, reordered) when told to stop
+def runShim(receiverAddress, loss, reorder, control):
+    sock = socket(AF_INET, SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.setsockopt(SOL_SOCKET, SO_RCVBUF, 4 << 20)
+    control.send(sock.getsockname())
+
+    senderAddress = None
+    # Datagram held back to be sent after the next one, as (data, destination)
+    held = None
+    dropped = 0
+    reordered = 0
+
+    while True:
+        readable, writable, errored = select.select([sock, control], [], [], 0.05)
+        if control in readable:
+            control.recv()
+            control.send((dropped, reordered))
+            break
+        if not readable:
+            # Nothing else is coming to overtake the held datagram
+            if held is not None:
+                sock.sendto(*held)
+                held = None
+            continue
+
+        data, address = sock.recvfrom(65536)
+        if address == receiverAddress:
+            destination = senderAddress
+        else:
+            senderAddress = address
+            destination = receiverAddress
+        if destination is None:
+            continue
+
+        if random.random() < loss:
+            dropped += 1
+            continue
+        if held is None and random.random() < reorder:
+            held = (data, destination)
+            reordered += 1
+            continue
+        sock.sendto(data, destination)
+        if held is not None:
+            sock.sendto(*held)
+            held = None
+    sock.close()
+
+
+"""
+    Benchmark
+"""
+
+
+# Given a path and size writes a file of random bytes, or of numbered sample
+# lines like EDG files if --content=samples
+# A block slightly longer than a megabyte is repeated so large files are quick to
+# make, and its odd length means no two chunks of a file are the same
+def writeSyntheticFile(path, size):
+    if fileContent == "samples":
+        block = "".join(f"{i}\n" for i in range(1, 160000)).encode()[: (1 << 20) + 13]
+    else:
+        block = os.urandom((1 << 20) + 13)
+    syntheticFile = open(path, "wb")
+    remaining = size
+    while remaining > 0:
+        syntheticFile.write(block[: min(remaining, len(block))])
+        remaining -= len(block)
+    syntheticFile.close()
+
+
+# Given a path returns the SHA-256 of its contents
+def fileChecksum(path):
+    checksum = hashlib.sha256()
+    checksumFile = open(path, "rb")
+    while True:
+        block = checksumFile.read(1 << 20)
+        if block == b"":
+            break
+        checksum.update(block)
+    checksumFile.close()
+    return checksum.hexdigest()
+
+
+# Given a size returns it with a K, M or G suffix
+def formatSize(size):
+    for suffix, multiplier in [("G", 1 << 30), ("M", 1 << 20), ("K", 1 << 10)]:
+        if size >= multiplier:
+            return f"{size / multiplier:g}{suffix}"
+    return str(size)
+
+
+def runBenchmark():
+    workDirectory = tempfile.mkdtemp(prefix="uvf-bench-")
+    sourceDirectory = os.path.join(workDirectory, "source")
+    outputDirectory = os.path.join(workDirectory, "received")
+    os.mkdir(sourceDirectory)
+    os.mkdir(outputDirectory)
+
+    receiverControl, receiverEnd = multiprocessing.Pipe()
+    receiverProcess = multiprocessing.Process(
+        target=runReceiver, args=(outputDirectory, receiverEnd), daemon=True
+    )
+    receiverProcess.start()
+    peerAddress = receiverControl.recv()
+
+    shimControl = None
+    if lossRate > 0 or reorderRate > 0:
+        shimControl, shimEnd = multiprocessing.Pipe()
+        shimProcess = multiprocessing.Process(
+            target=runShim,
+            args=(peerAddress, lossRate, reorderRate, shimEnd),
+            daemon=True,
+        )
+        shimProcess.start()
+        peerAddress = shimControl.recv()
+
+    print(
+        f"\n===== UVF benchmark: chunk {chunkSize} bytes, loss {lossRate:g}, reorder {reorderRate:g}, "
+        f"{fileContent} content, compression {compression} ====="
+    )
+    print(
+        f"{'size':>8}{'MB/s':>10}{'send ms/MB':>12}{'recv ms/MB':>12}{'packets':>10}{'resent':>8}{'compressed':>12}{'wire %':>8}  checksum"
+    )
+
+    allMatched = True
+    try:
+        for size in fileSizes:
+            sourcePath = os.path.join(sourceDirectory, f"bench-{size}.bin")
+            writeSyntheticFile(sourcePath, size)
+            sourceChecksum = fileChecksum(sourcePath)
+
+            for repeat in range(nRepeats):
+                receiverControl.send("mark")
+                receiverStartCpu = receiverControl.recv()
+
+                startTime = time.perf_counter()
+                startCpu = time.process_time()
+                sender = sendFile(
+                    sourcePath,
+                    peerAddress,
+                    "bench",
+                    chunkSize=chunkSize,
+                    compression=None if compression == "none" else compression,
+                    compressionLevel=compressionLevel,
+                )
+                senderCpu = time.process_time() - startCpu
+
+                fileName, receiverEndCpu = receiverControl.recv()
+                elapsed = time.perf_counter() - startTime
+                if fileName is None:
+                    print(f"{formatSize(size):>8}  receiver failed: {receiverEndCpu}")
+                    allMatched = False
+                    continue
+                receiverCpu = receiverEndCpu - receiverStartCpu
+
+                receivedPath = os.path.join(outputDirectory, fileName)
+                matched = fileChecksum(receivedPath) == sourceChecksum
+                allMatched = allMatched and matched
+                os.remove(receivedPath)
+
+                # Rates are meaningless for an empty file
+                megabytes = size / (1 << 20)
+                if size == 0:
+                    rates = f"{'-':>10}{'-':>12}{'-':>12}"
+                else:
+                    rates = (
+                        f"{megabytes / elapsed:>10.1f}{senderCpu * 1000 / megabytes:>12.1f}"
+                        f"{receiverCpu * 1000 / megabytes:>12.1f}"
+                    )
+                # Chunk bytes sent, after compression, as a share of the file
+                wirePercent = "-"
+                if size > 0:
+                    wirePercent = f"{sender.chunkBytesSent * 100 / size:.0f}"
+                print(
+                    f"{formatSize(size):>8}{rates}"
+                    f"{sender.packetsSent:>10}{sender.packetsRetransmitted:>8}"
+                    f"{sender.packetsCompressed:>12}{wirePercent:>8}"
+                    f"  {'ok' if matched else 'MISMATCH'}"
+                )
+            os.remove(sourcePath)
+    finally:
+        if shimControl is not None:
+            shimControl.send("stop")
+            dropped, reordered = shimControl.recv()
+            print(f"shim: {dropped} datagrams dropped, {reordered} reordered")
+        receiverControl.send("stop")
+        receiverProcess.join()
+        shutil.rmtree(workDirectory, ignore_errors=True)
+
+    print("all checksums match" if allMatched else "SOME TRANSFERS FAILED")
+
+
+if __name__ == "__main__":
+    runBenchmark()